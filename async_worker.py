@@ -0,0 +1,246 @@
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from kombu import Exchange, Queue
+from kombu.exceptions import OperationalError
+from dashscope import AioGeneration
+from app import create_app
+from extensions import db
+from config import Config
+from tasks import (
+    celery_app,
+    ChatGenerationTask,
+    GENERATION_MODEL,
+    GENERATION_PARAMETERS,
+    save_generation_result,
+    save_generation_failure,
+)
+from task_state import is_task_cancelled
+from generation_limiter import GenerationLease, get_scope
+from streaming import open_chunk_publisher, ChunkCoalescer, broker_parameters, BrokerChannelPool
+from result_cache import get_fingerprint, get_cached_result, store_result, replay_result
+import asyncio
+import itertools
+import queue
+import socket
+import threading
+import time
+import sys
+
+
+class AsyncGenerationWorker:
+    """
+    Runs many streaming chat generations concurrently in one process.
+    Generation tasks are routed to ASYNC_GENERATION_QUEUE when GENERATION_WORKER_MODE is "asyncio".
+    A consumer thread reads them from the Celery broker and hands them to the event loop, which runs
+    up to ASYNC_WORKER_CONCURRENCY of them at a time. Messages are acknowledged once the task is done.
+
+    Blocking calls (publishing frames, checking for cancellation, persisting results) run on a pool of
+    ASYNC_WORKER_IO_THREADS I/O lanes. Every task is assigned one lane and makes all of its calls on it,
+    so its frames are published in order and each broker connection is only used from its lane's thread.
+    """
+
+    def __init__(self, app, concurrency: int, io_threads: int):
+        self.app = app
+        self.concurrency = concurrency
+        self.loop = None
+        self._semaphore = None
+        self._acks = queue.Queue()
+        self._lanes = [_IOLane(app) for _ in range(io_threads)]
+        self._next_lane = itertools.cycle(self._lanes)
+
+    def _persist(self, function, *args):
+        """
+        Run a persistence function on the I/O thread with a fresh database session.
+        """
+        try:
+            return function(*args)
+        finally:
+            db.session.remove()
+
+    def _consume(self):
+        """
+        Consume generation tasks from the broker. Runs in its own thread, which owns the broker connection.
+        """
+        name = Config.ASYNC_GENERATION_QUEUE
+        task_queue = Queue(name, Exchange(name), routing_key=name)
+        while True:
+            try:
+                with celery_app.connection_for_read() as connection:
+                    with connection.Consumer(
+                        task_queue,
+                        callbacks=[self._on_message],
+                        accept=["json"],
+                        prefetch_count=self.concurrency,
+                    ):
+                        while True:
+                            while not self._acks.empty():
+                                self._acks.get().ack()
+                            try:
+                                connection.drain_events(timeout=0.1)
+                            except socket.timeout:
+                                pass
+            except (OSError, OperationalError):
+                time.sleep(1)
+
+    def _on_message(self, body, message):
+        if message.headers.get("task") != ChatGenerationTask.name:
+            message.reject()
+            return
+        task_id = message.headers["id"]
+        args, kwargs, _ = body
+        asyncio.run_coroutine_threadsafe(self._handle(task_id, message, *args, **kwargs), self.loop)
+
+    async def _handle(self, task_id, message, chat_id, messages, use_cache=False):
+        async with self._semaphore:
+            lane = next(self._next_lane)
+            try:
+                content, cancelled, source = await self._generate(lane, task_id, messages, use_cache)
+            except Exception as e:
+                await lane.call(self._persist, save_generation_failure, chat_id, task_id, e)
+                await lane.call(celery_app.backend.mark_as_failure, task_id, e)
+            else:
+                await lane.call(self._persist, save_generation_result, chat_id, task_id, content, cancelled, source)
+                await lane.call(celery_app.backend.mark_as_done, task_id, content)
+            finally:
+                self._acks.put(message)
+
+    async def _generate(self, lane, task_id, messages, use_cache):
+        """
+        The asyncio counterpart of ChatGenerationTask.run.
+        Returns the reply, whether it was cancelled and whether it was generated or served from the result cache.
+        """
+        redis_client = self.app.config["REDIS_CLIENT"]
+        publisher_context = open_chunk_publisher(lane.broker_pool, redis_client, task_id)
+        publisher = await lane.call(publisher_context.__enter__)
+        try:
+            result = await self._stream(lane, task_id, messages, use_cache, publisher)
+        except BaseException:
+            await lane.call(publisher_context.__exit__, *sys.exc_info())
+            raise
+        await lane.call(publisher_context.__exit__, None, None, None)
+        return result
+
+    async def _stream(self, lane, task_id, messages, use_cache, publisher):
+        # In-progress frames are published on the I/O lane without waiting for the broker
+        coalescer = ChunkCoalescer(
+            _DeferredPublisher(self.app, lane, publisher, task_id), Config.STREAM_COALESCE_DELAY, Config.STREAM_COALESCE_BYTES
+        )
+        cancelled = False
+        source = "generation"
+        try:
+            # The task may have been cancelled while it was queued
+            if await lane.call(is_task_cancelled, task_id):
+                await lane.call(publisher.publish, {"status": "cancelled", "content": ""})
+                return "", True, source
+
+            # Identical requests made with a cache-enabled preset are answered from the result cache
+            fingerprint = get_fingerprint(GENERATION_MODEL, GENERATION_PARAMETERS, messages) if use_cache else None
+            cached = await lane.call(get_cached_result, fingerprint) if fingerprint else None
+            if cached is not None:
+                source = "cache"
+                replay_result(coalescer, cached)
+            else:
+                cancelled = await self._call_model(lane, task_id, messages, coalescer)
+        except Exception as e:
+            # Let streaming clients know the generation failed
+            try:
+                await lane.call(publisher.publish, {"status": "error", "content": str(e)})
+            except Exception:
+                self.app.logger.exception("Failed to publish the error frame of task %s", task_id)
+            raise
+
+        full_content = coalescer.content
+        await lane.call(publisher.publish, {"status": "cancelled" if cancelled else "success", "content": full_content})
+        if fingerprint and source == "generation" and not cancelled:
+            await lane.call(store_result, fingerprint, full_content)
+        return full_content, cancelled, source
+
+    async def _call_model(self, lane, task_id, messages, coalescer) -> bool:
+        """
+        Stream a reply from the model into the coalescer. Returns whether the task was cancelled.
+        """
+        # Wait for a free generation slot of this model and API key without blocking the event loop
+        redis_client = self.app.config["REDIS_CLIENT"]
+        lease = GenerationLease(redis_client, get_scope(GENERATION_MODEL, Config.DASHSCOPE_API_KEY))
+        while not await lane.call(lease.try_acquire):
+            if lease.expired():
+                await lane.call(lease.timeout)
+            await asyncio.sleep(Config.GENERATION_QUEUE_POLL_INTERVAL)
+
+        try:
+            # Generate chat
+            responses = await AioGeneration.call(GENERATION_MODEL, messages=messages, stream=True, **GENERATION_PARAMETERS)
+
+            next_cancel_check = time.monotonic() + Config.TASK_CANCEL_CHECK_INTERVAL
+            async for response in responses:
+                if response.status_code != HTTPStatus.OK:
+                    raise Exception(f"Error occurred while generating chat: {response.message}")
+                coalescer.add(response.output.choices[0]['message']['content'])
+
+                if time.monotonic() >= next_cancel_check:
+                    if await lane.call(is_task_cancelled, task_id):
+                        # Closing the generator closes the upstream HTTP stream
+                        await responses.aclose()
+                        coalescer.flush()
+                        return True
+                    await lane.call(lease.renew_if_due)
+                    next_cancel_check = time.monotonic() + Config.TASK_CANCEL_CHECK_INTERVAL
+            coalescer.flush()
+            return False
+        finally:
+            await lane.call(lease.release)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        consumer = threading.Thread(target=self._consume, name="async-worker-consumer", daemon=True)
+        consumer.start()
+        while consumer.is_alive():
+            await asyncio.sleep(1)
+
+
+class _IOLane:
+    """
+    A single I/O thread with an application context and a broker connection of its own.
+    Calls run in submission order, and pika connections are never shared between threads.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.broker_pool = BrokerChannelPool(broker_parameters(), Config.RABBITMQ_MAX_IDLE_CHANNELS)
+        self.executor = ThreadPoolExecutor(max_workers=1, initializer=self._init_thread)
+
+    def _init_thread(self):
+        self.app.app_context().push()
+
+    async def call(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+
+class _DeferredPublisher:
+    """
+    Publishes frames on the task's I/O lane without blocking the event loop.
+    Frames of one task are published in order because the lane runs them in submission order.
+    Failures are logged, the final frame is published and checked by the task itself.
+    """
+
+    def __init__(self, app, lane: _IOLane, publisher, task_id):
+        self.app = app
+        self.lane = lane
+        self.publisher = publisher
+        self.task_id = task_id
+
+    def publish(self, frame: dict):
+        future = self.lane.executor.submit(self.publisher.publish, frame)
+        future.add_done_callback(self._log_failure)
+
+    def _log_failure(self, future):
+        exc = future.exception()
+        if exc is not None:
+            self.app.logger.error("Failed to publish a frame of task %s: %s", self.task_id, exc)
+
+
+if __name__ == "__main__":
+    app = create_app()
+    worker = AsyncGenerationWorker(app, Config.ASYNC_WORKER_CONCURRENCY, Config.ASYNC_WORKER_IO_THREADS)
+    asyncio.run(worker.run())
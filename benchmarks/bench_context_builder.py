@@ -0,0 +1,56 @@
+"""
+Benchmark the time to build a generation request for long chats.
+
+Compares sending the whole history with the token-budget context builder.
+Run from the repository root: python benchmarks/bench_context_builder.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from context_builder import build_context, to_model_message  # noqa: E402
+
+CHAT_SIZES = [10000, 50000, 100000]
+BUDGET = 6000
+REPEAT = 20
+
+PRESET = [{"role": "system", "content": "You are a helpful assistant. 你是一个乐于助人的助手。"}]
+
+
+def make_chat(size):
+    return [
+        {
+            "type": "text",
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": f"Message {i}: " + ("这是一条测试消息。" if i % 3 else "This is a test message. ") * 8,
+            "visible": True,
+        }
+        for i in range(size)
+    ]
+
+
+def build_full(chat):
+    return [to_model_message(message) for message in PRESET] + [to_model_message(message) for message in chat]
+
+
+def build_budgeted(chat):
+    return build_context(PRESET, reversed(chat), BUDGET)
+
+
+def bench(function, chat):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        messages = function(chat)
+    elapsed = (time.perf_counter() - start) / REPEAT
+    return elapsed * 1000, len(messages)
+
+
+if __name__ == "__main__":
+    print(f"{'messages':>10} {'full (ms)':>12} {'sent':>8} {'budgeted (ms)':>14} {'sent':>6}")
+    for size in CHAT_SIZES:
+        chat = make_chat(size)
+        full_ms, full_count = bench(build_full, chat)
+        budgeted_ms, budgeted_count = bench(build_budgeted, chat)
+        print(f"{size:>10} {full_ms:>12.2f} {full_count:>8} {budgeted_ms:>14.3f} {budgeted_count:>6}")
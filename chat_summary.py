@@ -0,0 +1,81 @@
+from flask import current_app
+from http import HTTPStatus
+from dashscope import Generation
+from extensions import db
+from orm_models.chat import ChatORM
+from config import Config
+from generation_limiter import acquire_generation_slot
+
+# Long chats keep a rolling summary of their older messages. Messages with a seq below chat.summary_upto
+# are covered by chat.summary, and each run only folds the messages added since the previous run into it.
+
+SUMMARY_PROMPT = (
+    "You maintain the memory of a conversation between a user and an assistant. "
+    "Update the existing summary with the new messages. Keep facts, names, preferences, decisions and open questions, "
+    "drop small talk, and answer with the updated summary only, in the language of the conversation."
+)
+
+
+def _lock_key(chat_id) -> str:
+    return f"chat_summary:{chat_id}"
+
+
+def needs_summary(chat) -> bool:
+    """
+    Whether enough messages have piled up outside the summary and the recent window to update the summary.
+    """
+    return chat.message_count - Config.SUMMARY_KEEP_RECENT - chat.summary_upto >= Config.SUMMARY_TRIGGER_LENGTH
+
+
+def claim_summary(chat_id) -> bool:
+    """
+    Make sure only one summary job runs per chat. Returns False if one is already queued or running.
+    """
+    redis_client = current_app.config["REDIS_CLIENT"]
+    return bool(redis_client.set(_lock_key(chat_id), 1, nx=True, ex=Config.SUMMARY_LOCK_TTL))
+
+
+def release_summary(chat_id):
+    redis_client = current_app.config["REDIS_CLIENT"]
+    redis_client.delete(_lock_key(chat_id))
+
+
+def summarize_chat(chat) -> int:
+    """
+    Fold the messages added since the last summary, except the recent window, into the chat summary.
+    Returns the number of messages summarized.
+    The summary is only saved if the history was not replaced while it was generated, otherwise it would describe
+    messages that no longer exist. Messages appended in the meantime do not affect the summarized range.
+    """
+    chat.migrate_content()
+    history_version, summary_upto = chat.history_version, chat.summary_upto
+    stop = min(chat.message_count - Config.SUMMARY_KEEP_RECENT, chat.summary_upto + Config.SUMMARY_MAX_MESSAGES)
+    if stop <= chat.summary_upto:
+        return 0
+
+    transcript = "\n".join(
+        f"{message['role']}: {message['content']}"
+        for message in chat.get_content(chat.summary_upto, stop)
+        if message["type"] == "text"
+    )
+    messages = [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": f"Existing summary:\n{chat.summary or '(none)'}\n\nNew messages:\n{transcript}"},
+    ]
+
+    redis_client = current_app.config["REDIS_CLIENT"]
+    lease = acquire_generation_slot(redis_client, Config.SUMMARY_MODEL, Config.DASHSCOPE_API_KEY)
+    try:
+        response = Generation.call(Config.SUMMARY_MODEL, messages=messages, result_format='message')
+    finally:
+        lease.release()
+    if response.status_code != HTTPStatus.OK:
+        raise Exception(f"Error occurred while summarizing chat: {response.message}")
+
+    summarized = stop - chat.summary_upto
+    saved = ChatORM.query.filter_by(id=chat.id, history_version=history_version, summary_upto=summary_upto).update(
+        {ChatORM.summary: response.output.choices[0]['message']['content'], ChatORM.summary_upto: stop},
+        synchronize_session=False,
+    )
+    db.session.commit()
+    return summarized if saved else 0
@@ -1,6 +1,7 @@
 import os
 from dotenv import load_dotenv
 from datetime import timedelta
+import json
 
 # Load environment variables from .env file
 load_dotenv()
@@ -33,6 +34,9 @@ class Config:
     JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(minutes=int(os.getenv("JWT_ACCESS_TOKEN_EXPIRES")))
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(minutes=int(os.getenv("JWT_ACCESS_TOKEN_EXPIRES")))
+    JWT_REVOCATION_DEFAULT_TTL = int(os.getenv("JWT_REVOCATION_DEFAULT_TTL", 2592000))
+    JWT_REVOCATION_NEGATIVE_TTL = float(os.getenv("JWT_REVOCATION_NEGATIVE_TTL", 5))
+    JWT_REVOCATION_CACHE_SIZE = int(os.getenv("JWT_REVOCATION_CACHE_SIZE", 10000))
 
     # Redis configuration
     REDIS_HOST = os.getenv("REDIS_HOST")
@@ -40,6 +44,18 @@ class Config:
     REDIS_DB = os.getenv("REDIS_DB")
     REDIS_PASSWORD = os.getenv("REDIS_PASSWORD")
 
+    # Identity cache configuration
+    IDENTITY_LOCAL_TTL = float(os.getenv("IDENTITY_LOCAL_TTL", 10))
+    IDENTITY_REDIS_TTL = int(os.getenv("IDENTITY_REDIS_TTL", 300))
+    IDENTITY_CACHE_SIZE = int(os.getenv("IDENTITY_CACHE_SIZE", 10000))
+
+    # RabbitMQ configuration
+    RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "localhost")
+    RABBITMQ_PORT = int(os.getenv("RABBITMQ_PORT", 5672))
+    RABBITMQ_HEARTBEAT = int(os.getenv("RABBITMQ_HEARTBEAT", 30))
+    RABBITMQ_MAX_IDLE_CHANNELS = int(os.getenv("RABBITMQ_MAX_IDLE_CHANNELS", 4))
+    STREAM_EXCHANGE = os.getenv("STREAM_EXCHANGE", "task_streams")
+
     # WeChat Mini Program configuration
     WECHAT_APPID = os.getenv("WECHAT_APPID")
     WECHAT_SECRET = os.getenv("WECHAT_SECRET")
@@ -51,6 +67,86 @@ class Config:
     CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND")
     CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL")
 
+    # Generation worker configuration
+    # "celery" runs one generation per prefork process, "asyncio" routes generations to async_worker.py
+    GENERATION_WORKER_MODE = os.getenv("GENERATION_WORKER_MODE", "celery")
+    ASYNC_GENERATION_QUEUE = os.getenv("ASYNC_GENERATION_QUEUE", "generation_async")
+    ASYNC_WORKER_CONCURRENCY = int(os.getenv("ASYNC_WORKER_CONCURRENCY", 200))
+    ASYNC_WORKER_IO_THREADS = int(os.getenv("ASYNC_WORKER_IO_THREADS", 16))
+
+    # Generation admission control configuration
+    # At most GENERATION_CONCURRENCY_LIMIT generations run at once per model and API key across all workers
+    GENERATION_CONCURRENCY_LIMIT = int(os.getenv("GENERATION_CONCURRENCY_LIMIT", 20))
+    GENERATION_LEASE_TTL = int(os.getenv("GENERATION_LEASE_TTL", 60))
+    GENERATION_QUEUE_TIMEOUT = float(os.getenv("GENERATION_QUEUE_TIMEOUT", 60))
+    GENERATION_QUEUE_POLL_INTERVAL = float(os.getenv("GENERATION_QUEUE_POLL_INTERVAL", 0.2))
+
+    # Fair-share scheduler configuration
+    # Dispatch weights by permission level, a user of weight 2 is served twice as often as a user of weight 1
+    SCHEDULER_LEVEL_WEIGHTS = json.loads(os.getenv("SCHEDULER_LEVEL_WEIGHTS", '{"1": 1, "2": 2}'))
+    SCHEDULER_MAX_IN_FLIGHT = int(os.getenv("SCHEDULER_MAX_IN_FLIGHT", 100))
+    SCHEDULER_USER_MAX_IN_FLIGHT = int(os.getenv("SCHEDULER_USER_MAX_IN_FLIGHT", 2))
+    SCHEDULER_RUNNING_TTL = int(os.getenv("SCHEDULER_RUNNING_TTL", 3600))
+
+    # Task streaming configuration
+    TASK_STATE_TTL = int(os.getenv("TASK_STATE_TTL", 86400))
+    STREAM_HEARTBEAT_INTERVAL = float(os.getenv("STREAM_HEARTBEAT_INTERVAL", 15))
+    STREAM_TIMEOUT = float(os.getenv("STREAM_TIMEOUT", 300))
+    TASK_WAIT_MAX = float(os.getenv("TASK_WAIT_MAX", 30))
+    TASK_CANCEL_CHECK_INTERVAL = float(os.getenv("TASK_CANCEL_CHECK_INTERVAL", 0.2))
+    # "rabbitmq" or "redis", Redis Streams keep the frames so clients can resume after a reconnect
+    STREAM_TRANSPORT = os.getenv("STREAM_TRANSPORT", "rabbitmq")
+    STREAM_MAX_LENGTH = int(os.getenv("STREAM_MAX_LENGTH", 10000))
+    STREAM_TTL = int(os.getenv("STREAM_TTL", 600))
+    STREAM_HUB_BLOCK_MS = int(os.getenv("STREAM_HUB_BLOCK_MS", 5000))
+    # Incremental output is published at most every STREAM_COALESCE_DELAY seconds or STREAM_COALESCE_BYTES bytes
+    STREAM_COALESCE_DELAY = float(os.getenv("STREAM_COALESCE_DELAY", 0.04))
+    STREAM_COALESCE_BYTES = int(os.getenv("STREAM_COALESCE_BYTES", 256))
+
+    # Credit ledger configuration
+    CREDIT_RESERVATION = int(os.getenv("CREDIT_RESERVATION", 500))
+    CREDIT_LEDGER_TTL = int(os.getenv("CREDIT_LEDGER_TTL", 86400))
+    CREDIT_RECONCILE_INTERVAL = int(os.getenv("CREDIT_RECONCILE_INTERVAL", 3600))
+
+    # Preset catalog cache configuration
+    PRESET_CATALOG_TTL = int(os.getenv("PRESET_CATALOG_TTL", 3600))
+    PRESET_CATALOG_LOCAL_TTL = float(os.getenv("PRESET_CATALOG_LOCAL_TTL", 60))
+    PRESET_CATALOG_VERSION_TTL = float(os.getenv("PRESET_CATALOG_VERSION_TTL", 1))
+    PRESET_CATALOG_CACHE_SIZE = int(os.getenv("PRESET_CATALOG_CACHE_SIZE", 1000))
+
+    # Chat history configuration
+    CHAT_PAGE_SIZE = int(os.getenv("CHAT_PAGE_SIZE", 50))
+    CHAT_PAGE_MAX_SIZE = int(os.getenv("CHAT_PAGE_MAX_SIZE", 200))
+    CHAT_LIST_PAGE_SIZE = int(os.getenv("CHAT_LIST_PAGE_SIZE", 20))
+    CHAT_LIST_PAGE_MAX_SIZE = int(os.getenv("CHAT_LIST_PAGE_MAX_SIZE", 100))
+    BATCH_GET_MAX_ITEMS = int(os.getenv("BATCH_GET_MAX_ITEMS", 50))
+
+    # Context builder configuration
+    # Estimated tokens of preset and history sent with each generation request
+    CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 6000))
+    CONTEXT_BATCH_SIZE = int(os.getenv("CONTEXT_BATCH_SIZE", 100))
+
+    # Chat summary configuration
+    # Older messages are summarized once SUMMARY_TRIGGER_LENGTH of them lie outside the summary and the last SUMMARY_KEEP_RECENT
+    SUMMARY_TRIGGER_LENGTH = int(os.getenv("SUMMARY_TRIGGER_LENGTH", 40))
+    SUMMARY_KEEP_RECENT = int(os.getenv("SUMMARY_KEEP_RECENT", 20))
+    SUMMARY_MAX_MESSAGES = int(os.getenv("SUMMARY_MAX_MESSAGES", 200))
+    SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "qwen-turbo")
+    SUMMARY_LOCK_TTL = int(os.getenv("SUMMARY_LOCK_TTL", 600))
+
+    # Result cache configuration
+    RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", 86400))
+    RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 10000))
+
+    # Single-flight configuration
+    # Longest time an identical request can join a running generation
+    SINGLE_FLIGHT_TTL = int(os.getenv("SINGLE_FLIGHT_TTL", 600))
+
+    # Idempotency configuration
+    # Responses are replayed for IDEMPOTENCY_TTL seconds, a request that has not finished within IDEMPOTENCY_LOCK_TTL seconds can be retried
+    IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", 86400))
+    IDEMPOTENCY_LOCK_TTL = int(os.getenv("IDEMPOTENCY_LOCK_TTL", 60))
+
     # Other configurations
     MAX_CONTENT_LENGTH = int(os.getenv("MAX_CONTENT_LENGTH"))
     STORAGE_TYPE = os.getenv("STORAGE_TYPE")
@@ -0,0 +1,51 @@
+import re
+
+# Builds the message list sent to the model for a chat.
+# Token counts are estimated locally, so building a context never calls the tokenizer of the provider.
+# The output only depends on the inputs, so equal histories always give equal contexts.
+
+# CJK characters are roughly one token each, other text is roughly four characters per token
+CJK_PATTERN = re.compile("[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+MESSAGE_OVERHEAD = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens of a text.
+    """
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def estimate_message_tokens(message: dict) -> int:
+    return estimate_tokens(message["content"]) + MESSAGE_OVERHEAD
+
+
+def to_model_message(message: dict) -> dict:
+    return {"role": message["role"], "content": message["content"]}
+
+
+def build_context(preset_messages, recent_messages, budget: int, summary=None) -> list:
+    """
+    Build the messages of a generation request.
+    The preset messages and the chat summary, if any, are always kept. The rest of the token budget is filled
+    with the most recent chat messages, which `recent_messages` must yield newest first. The newest message
+    is always kept, even if it does not fit, and the kept history never starts with an assistant message.
+    """
+    context = [to_model_message(message) for message in preset_messages]
+    if summary:
+        context.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"})
+    remaining = budget - sum(estimate_message_tokens(message) for message in context)
+
+    history = []
+    for message in recent_messages:
+        tokens = estimate_message_tokens(message)
+        if history and tokens > remaining:
+            break
+        history.append(to_model_message(message))
+        remaining -= tokens
+    history.reverse()
+
+    while len(history) > 1 and history[0]["role"] == "assistant":
+        history.pop(0)
+    return context + history
@@ -0,0 +1,152 @@
+from flask import current_app
+from sqlalchemy import inspect, select, text
+from sqlalchemy.sql import func
+from extensions import db
+from orm_models.user import UserORM
+from orm_models.usage import UsageORM
+from config import Config
+
+# Reserve credits for a task if the cached balance is positive.
+# Returns nil if the balance is not cached yet, 0 if there are not enough credits, 1 otherwise.
+RESERVE_SCRIPT = """
+local balance = redis.call('GET', KEYS[1])
+if not balance then
+    return nil
+end
+if tonumber(balance) <= 0 then
+    return 0
+end
+redis.call('DECRBY', KEYS[1], ARGV[2])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return 1
+"""
+
+# Seed the cached balance from the credits left in the database, minus the credits reserved by running tasks.
+# The reservations are summed inside Redis and the balance is only set if it is not cached yet,
+# so a reservation or settlement made while the database was read is neither lost nor counted twice.
+SEED_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+local reserved = 0
+for _, amount in ipairs(redis.call('HVALS', KEYS[2])) do
+    reserved = reserved + tonumber(amount)
+end
+redis.call('SET', KEYS[1], tonumber(ARGV[1]) - reserved, 'EX', ARGV[2])
+return 1
+"""
+
+# Replace a task's reservation with the credits it actually used.
+SETTLE_SCRIPT = """
+local reserved = redis.call('HGET', KEYS[2], ARGV[1])
+if not reserved then
+    return 0
+end
+redis.call('HDEL', KEYS[2], ARGV[1])
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('INCRBY', KEYS[1], tonumber(reserved) - tonumber(ARGV[2]))
+end
+return 1
+"""
+
+
+def _balance_key(user_id) -> str:
+    return f"credits:{user_id}:balance"
+
+
+def _reservations_key(user_id) -> str:
+    return f"credits:{user_id}:reservations"
+
+
+def _load_balance(user_id):
+    """
+    Seed the cached balance from the user's counters, minus the credits currently reserved by running tasks.
+    """
+    redis_client = current_app.config["REDIS_CLIENT"]
+    credits_left = (
+        db.session.query(UserORM.total_credits - UserORM.total_usage)
+        .filter(UserORM.id == user_id)
+        .scalar()
+    ) or 0
+    seed = redis_client.register_script(SEED_SCRIPT)
+    seed(keys=[_balance_key(user_id), _reservations_key(user_id)], args=[credits_left, Config.CREDIT_LEDGER_TTL])
+
+
+def reserve_credits(user_id, task_id) -> bool:
+    """
+    Atomically check that the user has credits left and reserve CREDIT_RESERVATION of them for a task.
+    """
+    redis_client = current_app.config["REDIS_CLIENT"]
+    reserve = redis_client.register_script(RESERVE_SCRIPT)
+    keys = [_balance_key(user_id), _reservations_key(user_id)]
+    args = [task_id, Config.CREDIT_RESERVATION, Config.CREDIT_LEDGER_TTL]
+
+    result = reserve(keys=keys, args=args)
+    if result is None:
+        _load_balance(user_id)
+        result = reserve(keys=keys, args=args)
+    return result == 1
+
+
+def settle_credits(user_id, task_id, token_used):
+    """
+    Settle a task's reservation against the tokens it actually used.
+    Must be called after the usage has been committed to the database.
+    """
+    redis_client = current_app.config["REDIS_CLIENT"]
+    settle = redis_client.register_script(SETTLE_SCRIPT)
+    settle(keys=[_balance_key(user_id), _reservations_key(user_id)], args=[task_id, token_used])
+
+
+def release_credits(user_id, task_id):
+    """
+    Release a task's reservation without charging anything.
+    """
+    settle_credits(user_id, task_id, 0)
+
+
+def record_usage(user_id, token_used, source="generation"):
+    """
+    Record usage and add it to the user's running total. The caller is responsible for committing.
+    """
+    db.session.add(UsageORM(user_id=user_id, token_used=token_used, source=source))
+    UserORM.query.filter_by(id=user_id).update(
+        {UserORM.total_usage: UserORM.total_usage + token_used},
+        synchronize_session=False,
+    )
+
+
+def reconcile_credit_ledger() -> int:
+    """
+    Rebuild the users' running totals from the usages table and drop the cached balances.
+    Returns the number of users whose total had drifted.
+    """
+    # One UPDATE with a correlated subquery, so usage recorded while reconciling is not overwritten with a stale sum
+    usage_total = func.coalesce(
+        select(func.sum(UsageORM.token_used)).where(UsageORM.user_id == UserORM.id).scalar_subquery(),
+        0,
+    )
+    drifted = UserORM.query.filter(UserORM.total_usage != usage_total).update(
+        {UserORM.total_usage: usage_total},
+        synchronize_session=False,
+    )
+    db.session.commit()
+
+    redis_client = current_app.config["REDIS_CLIENT"]
+    for key in redis_client.scan_iter("credits:*:balance"):
+        redis_client.delete(key)
+
+    return drifted
+
+
+def migrate_credit_ledger() -> int:
+    """
+    Add the users.total_usage column to databases created before it existed and backfill it from the usages table.
+    Safe to run more than once. Returns the number of users whose total was backfilled.
+    """
+    columns = {column["name"] for column in inspect(db.engine).get_columns("users")}
+    if "total_usage" not in columns:
+        with db.engine.begin() as connection:
+            connection.execute(text("ALTER TABLE users ADD COLUMN total_usage INTEGER NOT NULL DEFAULT 0"))
+    return reconcile_credit_ledger()
@@ -1,9 +1,13 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_restx import Resource, Api, marshal
+from celery import Celery
 from models import message_model
+from config import Config
 
 db = SQLAlchemy()
 
+celery_app = Celery("tasks", backend=Config.CELERY_RESULT_BACKEND, broker=Config.CELERY_BROKER_URL)
+
 api = Api(
     version="1.0",
     title="ChatGPT WeChat Mini Program API",
@@ -0,0 +1,161 @@
+from config import Config
+from uuid import uuid4
+import hashlib
+import time
+
+# Cluster-wide admission control for Dashscope generation calls.
+# Each scope (model and API key) has a ZSET of lease holders scored by lease expiry, and a FIFO queue of waiters.
+# Holders that stop renewing their lease and waiters that stop polling are dropped, so crashed workers never leak slots.
+
+# Try to take a slot for a lease. The lease joins the queue on its first attempt and is granted a slot
+# once every lease ahead of it has been served and a slot is free.
+# Returns 1 if the slot was granted, 0 otherwise.
+ACQUIRE_SCRIPT = """
+local holders, queue, waiters, counter = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local lease_id, limit, now, lease_ttl, waiter_ttl = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5])
+
+redis.call('ZREMRANGEBYSCORE', holders, '-inf', now)
+local stale = redis.call('ZRANGEBYSCORE', waiters, '-inf', now - waiter_ttl)
+if #stale > 0 then
+    redis.call('ZREM', waiters, unpack(stale))
+    redis.call('ZREM', queue, unpack(stale))
+end
+
+if not redis.call('ZSCORE', queue, lease_id) then
+    redis.call('ZADD', queue, redis.call('INCR', counter), lease_id)
+end
+redis.call('ZADD', waiters, now, lease_id)
+
+local free = limit - redis.call('ZCARD', holders)
+if redis.call('ZRANK', queue, lease_id) < free then
+    redis.call('ZREM', queue, lease_id)
+    redis.call('ZREM', waiters, lease_id)
+    redis.call('ZADD', holders, now + lease_ttl, lease_id)
+    return 1
+end
+return 0
+"""
+
+SCOPES_KEY = "limiter:scopes"
+
+
+class GenerationQueueTimeout(Exception):
+    pass
+
+
+def get_scope(model, api_key) -> str:
+    """
+    Get the limiter scope of a model and API key. Only a hash of the key is stored.
+    """
+    key_hash = hashlib.sha1((api_key or "").encode()).hexdigest()[:12]
+    return f"{model}:{key_hash}"
+
+
+def _keys(scope):
+    prefix = f"limiter:{scope}"
+    return [f"{prefix}:holders", f"{prefix}:queue", f"{prefix}:waiters", f"{prefix}:counter"]
+
+
+def _stats_key(scope) -> str:
+    return f"limiter:{scope}:stats"
+
+
+class GenerationLease:
+    """
+    A request for a generation slot in a scope. Call `try_acquire` until it returns True or the deadline passes,
+    renew the lease while generating and release it when done.
+    """
+
+    def __init__(self, redis_client, scope, limit=None):
+        self.redis_client = redis_client
+        self.scope = scope
+        self.limit = limit or Config.GENERATION_CONCURRENCY_LIMIT
+        self.lease_id = str(uuid4())
+        self.created_at = time.time()
+        self.deadline = time.monotonic() + Config.GENERATION_QUEUE_TIMEOUT
+        self.acquired = False
+        self._renew_at = None
+
+    def try_acquire(self) -> bool:
+        acquire = self.redis_client.register_script(ACQUIRE_SCRIPT)
+        now = time.time()
+        args = [self.lease_id, self.limit, now, Config.GENERATION_LEASE_TTL, Config.GENERATION_QUEUE_POLL_INTERVAL * 10]
+        if acquire(keys=_keys(self.scope), args=args) != 1:
+            return False
+
+        self.acquired = True
+        self._renew_at = time.monotonic() + Config.GENERATION_LEASE_TTL / 2
+        waited = now - self.created_at
+        pipeline = self.redis_client.pipeline()
+        pipeline.sadd(SCOPES_KEY, self.scope)
+        pipeline.hincrby(_stats_key(self.scope), "acquired", 1)
+        pipeline.hincrbyfloat(_stats_key(self.scope), "wait_seconds", waited)
+        pipeline.execute()
+        if waited > float(self.redis_client.hget(_stats_key(self.scope), "max_wait_seconds") or 0):
+            self.redis_client.hset(_stats_key(self.scope), "max_wait_seconds", waited)
+        return True
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.deadline
+
+    def timeout(self):
+        """
+        Give up waiting and raise GenerationQueueTimeout.
+        """
+        self.release()
+        self.redis_client.sadd(SCOPES_KEY, self.scope)
+        self.redis_client.hincrby(_stats_key(self.scope), "timeouts", 1)
+        raise GenerationQueueTimeout("Too many generations in progress, please try again later")
+
+    def renew_if_due(self):
+        """
+        Extend the lease once half of it has elapsed. Must be called regularly while generating.
+        """
+        if self.acquired and time.monotonic() >= self._renew_at:
+            holders = _keys(self.scope)[0]
+            self.redis_client.zadd(holders, {self.lease_id: time.time() + Config.GENERATION_LEASE_TTL}, xx=True)
+            self._renew_at = time.monotonic() + Config.GENERATION_LEASE_TTL / 2
+
+    def release(self):
+        holders, queue, waiters, _ = _keys(self.scope)
+        pipeline = self.redis_client.pipeline()
+        pipeline.zrem(holders, self.lease_id)
+        pipeline.zrem(queue, self.lease_id)
+        pipeline.zrem(waiters, self.lease_id)
+        pipeline.execute()
+        self.acquired = False
+
+
+def acquire_generation_slot(redis_client, model, api_key) -> GenerationLease:
+    """
+    Wait in FIFO order for a generation slot of a model and API key.
+    Raises GenerationQueueTimeout if no slot is free within GENERATION_QUEUE_TIMEOUT seconds.
+    """
+    lease = GenerationLease(redis_client, get_scope(model, api_key))
+    while not lease.try_acquire():
+        if lease.expired():
+            lease.timeout()
+        time.sleep(Config.GENERATION_QUEUE_POLL_INTERVAL)
+    return lease
+
+
+def get_limiter_stats(redis_client) -> list:
+    """
+    Get the in-flight and queued generations and the wait statistics of every scope.
+    """
+    stats = []
+    for scope in sorted(redis_client.smembers(SCOPES_KEY)):
+        holders, queue, _, _ = _keys(scope)
+        counters = redis_client.hgetall(_stats_key(scope))
+        acquired = int(counters.get("acquired", 0))
+        wait_seconds = float(counters.get("wait_seconds", 0))
+        stats.append({
+            "scope": scope,
+            "in_flight": redis_client.zcount(holders, time.time(), "+inf"),
+            "queued": redis_client.zcard(queue),
+            "acquired": acquired,
+            "timeouts": int(counters.get("timeouts", 0)),
+            "average_wait": wait_seconds / acquired if acquired else 0,
+            "max_wait": float(counters.get("max_wait_seconds", 0)),
+        })
+    return stats
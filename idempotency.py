@@ -0,0 +1,85 @@
+from flask import current_app, request
+from flask_jwt_extended import current_user
+from flask_restx import marshal
+from functools import wraps
+from models import message_model
+from config import Config
+import hashlib
+import json
+
+# Clients may send an Idempotency-Key header with requests that create something.
+# The first response for a key is stored in Redis and replayed when the request is retried with the same key,
+# so a retried request never creates a second chat or starts a second generation.
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+
+IDEMPOTENCY_DOC = {
+    IDEMPOTENCY_HEADER: {
+        "in": "header",
+        "type": "string",
+        "description": "Unique key of the request. Retrying with the same key replays the first response.",
+    }
+}
+
+
+def _key(scope, user_id, idempotency_key) -> str:
+    return f"idempotency:{scope}:{user_id}:{idempotency_key}"
+
+
+def _split_response(response):
+    if not isinstance(response, tuple):
+        return response, 200, {}
+    body, status, headers = (response + (None, None))[:3]
+    return body, status or 200, dict(headers or {})
+
+
+def idempotent(scope):
+    """
+    Make a resource method idempotent per user and Idempotency-Key header. Must be applied below jwt_required.
+    Requests without the header are handled as usual. Reusing a key for a different path or body is rejected with 422.
+    Responses with a server error status are not stored, so the request can be retried.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+            if not idempotency_key:
+                return function(*args, **kwargs)
+            if len(idempotency_key) > 255:
+                return marshal({"message": "Idempotency-Key is too long"}, message_model), 400
+
+            redis_client = current_app.config["REDIS_CLIENT"]
+            key = _key(scope, current_user.id, idempotency_key)
+            # The path is part of the request, a key reused on another chat must not replay this chat's response
+            fingerprint = hashlib.sha256(request.path.encode("utf-8") + b"\n" + request.get_data()).hexdigest()
+
+            record = json.dumps({"state": "in_progress", "fingerprint": fingerprint})
+            if not redis_client.set(key, record, nx=True, ex=Config.IDEMPOTENCY_LOCK_TTL):
+                stored = redis_client.get(key)
+                if stored is None:
+                    return marshal({"message": "A request with this Idempotency-Key is in progress"}, message_model), 409
+                stored = json.loads(stored)
+                if stored["fingerprint"] != fingerprint:
+                    return marshal({"message": "Idempotency-Key was already used for a different request"}, message_model), 422
+                if stored["state"] == "in_progress":
+                    return marshal({"message": "A request with this Idempotency-Key is in progress"}, message_model), 409
+                headers = dict(stored["headers"], **{"Idempotent-Replayed": "true"})
+                return stored["body"], stored["status"], headers
+
+            try:
+                response = function(*args, **kwargs)
+            except Exception:
+                redis_client.delete(key)
+                raise
+
+            body, status, headers = _split_response(response)
+            if status >= 500:
+                redis_client.delete(key)
+            else:
+                record = {"state": "done", "fingerprint": fingerprint, "body": body, "status": status, "headers": headers}
+                redis_client.set(key, json.dumps(record, default=str), ex=Config.IDEMPOTENCY_TTL)
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,84 @@
+from flask import current_app
+from orm_models.user import UserORM
+from local_cache import LocalTTLCache
+from config import Config
+import json
+
+_local_identities = LocalTTLCache(
+    max_size=Config.IDENTITY_CACHE_SIZE,
+    ttl=Config.IDENTITY_LOCAL_TTL,
+)
+
+
+class UserIdentity:
+    """
+    A lightweight snapshot of a user, used as `current_user` for authenticated requests.
+    Only the columns needed on every request are cached. Any other attribute (credits, WeChat
+    session key, relationships) is read from the full `UserORM` row, which is loaded on first use.
+    """
+
+    fields = ("id", "username", "nickname", "permission_level", "avatar", "wechat_openid")
+
+    def __init__(self, data: dict):
+        for field in self.fields:
+            setattr(self, field, data.get(field))
+        self._user = None
+
+    @classmethod
+    def from_orm(cls, user: UserORM):
+        return cls({field: getattr(user, field) for field in cls.fields})
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.fields}
+
+    @property
+    def orm(self) -> UserORM:
+        """
+        The full user row, loaded lazily.
+        """
+        if self._user is None:
+            self._user = UserORM.query.filter_by(id=self.id, is_deleted=False).one()
+        return self._user
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.orm, name)
+
+
+def _identity_key(user_id) -> str:
+    return f"user_identity:{user_id}"
+
+
+def load_user_identity(user_id):
+    """
+    Resolve a user identity from the local cache, then Redis, then the database.
+    Returns None if the user does not exist or has been deleted.
+    """
+    identity = _local_identities.get(user_id)
+    if identity is not None:
+        return UserIdentity(identity)
+
+    redis_client = current_app.config["REDIS_CLIENT"]
+    cached = redis_client.get(_identity_key(user_id))
+    if cached:
+        identity = json.loads(cached)
+    else:
+        user = UserORM.query.filter_by(id=user_id, is_deleted=False).one_or_none()
+        if not user:
+            return None
+        identity = UserIdentity.from_orm(user).to_dict()
+        redis_client.set(_identity_key(user_id), json.dumps(identity), ex=Config.IDENTITY_REDIS_TTL)
+
+    _local_identities.set(user_id, identity)
+    return UserIdentity(identity)
+
+
+def invalidate_user_identity(user_id):
+    """
+    Drop a user's cached identity. Must be called after any change to the cached user columns.
+    Other worker processes may keep serving their local copy for up to IDENTITY_LOCAL_TTL seconds.
+    """
+    redis_client = current_app.config["REDIS_CLIENT"]
+    redis_client.delete(_identity_key(user_id))
+    _local_identities.delete(user_id)
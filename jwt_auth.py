@@ -1,4 +1,5 @@
-from orm_models.user import UserORM, TokenBlocklistORM
+from revocation import is_token_revoked
+from identity import load_user_identity
 from flask_jwt_extended import JWTManager
 
 jwt = JWTManager()
@@ -11,13 +12,12 @@ def user_identity_lookup(user):
 @jwt.user_lookup_loader
 def user_lookup_callback(jwt_header, jwt_data):
     identity = jwt_data["sub"]
-    return UserORM.query.filter_by(id=identity, is_deleted=False).one()
+    return load_user_identity(identity)
 
 
 @jwt.token_in_blocklist_loader
 def check_if_token_in_blocklist(jwt_header, jwt_data):
-    jti = jwt_data["jti"]
-    return TokenBlocklistORM.query.filter_by(jti=jti).one_or_none() is not None
+    return is_token_revoked(jwt_data)
 
 
 @jwt.expired_token_loader
@@ -72,6 +72,20 @@ chat_message_model = Model(
     },
 )
 
+append_messages_model = Model(
+    "AppendMessages",
+    {
+        "messages": fields.List(
+            fields.Nested(chat_message_model),
+            required=True,
+            description="The messages to append, type, visible and created_at are optional",
+        ),
+        "generate": fields.Boolean(
+            default=False, description="Start generating a reply after appending the messages"
+        ),
+    },
+)
+
 chat_model = Model(
     "Chat",
     {
@@ -87,7 +101,14 @@ chat_model = Model(
         "content": fields.List(
             fields.Nested(chat_message_model),
             required=True,
-            description="The content of the chat",
+            description="The content of the chat, or the requested window of it",
+        ),
+        "message_count": fields.Integer(
+            required=True, description="The total number of messages in the chat"
+        ),
+        "next_cursor": fields.Integer(
+            required=False,
+            description="The message index to pass as `after` (forward reads) or `before` (backward and tail reads) to get the next window, null if there is none",
         ),
         "created_at": fields.DateTime(
             required=True, description="The creation time of the chat"
@@ -98,12 +119,41 @@ chat_model = Model(
     },
 )
 
+chat_summary_model = Model(
+    "ChatSummary",
+    {
+        "id": fields.Integer(required=True, description="The chat unique identifier"),
+        "uuid": fields.String(required=True, description="The UUID of the chat"),
+        "preset_id": fields.Integer(
+            required=True, description="The preset unique identifier of the chat"
+        ),
+        "title": fields.String(required=True, description="The title of the chat"),
+        "message_count": fields.Integer(
+            required=True, description="The total number of messages in the chat"
+        ),
+        "last_message": fields.String(
+            required=False, description="A preview of the last message of the chat"
+        ),
+        "updated_at": fields.DateTime(
+            required=True, description="The update time of the chat"
+        ),
+    },
+)
+
 chat_list_model = Model(
     "ChatList",
     {
         "chat_ids": fields.List(
             fields.String, required=True, description="A list of chat UUIDs"
-        )
+        ),
+        "chats": fields.List(
+            fields.Nested(chat_summary_model),
+            required=True,
+            description="Summaries of the chats, most recently updated first",
+        ),
+        "next_cursor": fields.String(
+            required=False, description="The cursor of the next page, null if this is the last page"
+        ),
     },
 )
 
@@ -134,6 +184,9 @@ preset_model = Model(
             description="The visibility of the preset (private, unlisted, public)",
             enum=["public", "unlisted", "private"],
         ),
+        "cache_enabled": fields.Boolean(
+            required=True, description="Whether identical requests with the preset may be answered from the result cache"
+        ),
         "created_at": fields.DateTime(
             required=True, description="The creation time of the preset"
         ),
@@ -158,11 +211,96 @@ task_model = Model(
         "id": fields.String(required=True, description="The task unique identifier"),
         "status": fields.String(
             required=True,
-            description="The status of the task (PENDING, STARTED, SUCCESS, FAILURE)",
-            enum=["PENDING", "STARTED", "SUCCESS", "FAILURE"],
+            description="The status of the task (PENDING, STARTED, SUCCESS, FAILURE, REVOKED)",
+            enum=["PENDING", "STARTED", "SUCCESS", "FAILURE", "REVOKED"],
         ),
         "result": fields.String(
             required=False, description="The result of the task"
         ),
     },
-)
\ No newline at end of file
+)
+
+limiter_scope_model = Model(
+    "LimiterScope",
+    {
+        "scope": fields.String(required=True, description="The model and API key hash of the scope"),
+        "in_flight": fields.Integer(required=True, description="Number of generations currently holding a slot"),
+        "queued": fields.Integer(required=True, description="Number of generations waiting for a slot"),
+        "acquired": fields.Integer(required=True, description="Total number of slots granted"),
+        "timeouts": fields.Integer(required=True, description="Total number of generations that gave up waiting"),
+        "average_wait": fields.Float(required=True, description="Average wait for a slot in seconds"),
+        "max_wait": fields.Float(required=True, description="Longest wait for a slot in seconds"),
+    },
+)
+
+limiter_stats_model = Model(
+    "LimiterStats",
+    {
+        "scopes": fields.List(fields.Nested(limiter_scope_model), required=True, description="The limiter scopes"),
+    },
+)
+
+batch_get_model = Model(
+    "BatchGet",
+    {
+        "uuids": fields.List(
+            fields.String, required=True, description="The UUIDs of the items to get"
+        )
+    },
+)
+
+preset_batch_item_model = Model(
+    "PresetBatchItem",
+    {
+        "uuid": fields.String(required=True, description="The requested UUID"),
+        "status": fields.Integer(
+            required=True, description="The HTTP status of this item (200, 403, 404)"
+        ),
+        "message": fields.String(
+            required=False, description="The error message if the item could not be returned"
+        ),
+        "preset": fields.Nested(
+            preset_model, allow_null=True, description="The preset if status is 200"
+        ),
+    },
+)
+
+preset_batch_model = Model(
+    "PresetBatch",
+    {
+        "items": fields.List(
+            fields.Nested(preset_batch_item_model),
+            required=True,
+            description="The results in request order",
+        )
+    },
+)
+
+chat_batch_item_model = Model(
+    "ChatBatchItem",
+    {
+        "uuid": fields.String(required=True, description="The requested UUID"),
+        "status": fields.Integer(
+            required=True, description="The HTTP status of this item (200, 403, 404)"
+        ),
+        "message": fields.String(
+            required=False, description="The error message if the item could not be returned"
+        ),
+        "chat": fields.Nested(
+            chat_model,
+            allow_null=True,
+            description="The chat with its latest messages if status is 200",
+        ),
+    },
+)
+
+chat_batch_model = Model(
+    "ChatBatch",
+    {
+        "items": fields.List(
+            fields.Nested(chat_batch_item_model),
+            required=True,
+            description="The results in request order",
+        )
+    },
+)
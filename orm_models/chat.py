@@ -1,41 +1,345 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Index
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, or_, and_
 from extensions import db
+from orm_models.chat_message import ChatMessageORM
 from uuid import uuid4
 import json
 
+PREVIEW_LENGTH = 100
+
+
+def get_message_preview(message):
+    """
+    Get the short text shown for a message in chat listings.
+    """
+    if message.get("type") == "image":
+        return "[image]"
+    return message["content"][:PREVIEW_LENGTH]
+
+
+class ChatContent:
+    """
+    A lazy, read-only view over the messages of a chat.
+    Messages are only queried when the view is iterated or indexed, slices only load the requested range.
+    """
+
+    def __init__(self, chat):
+        self.chat = chat
+        self._messages = None
+
+    def _load(self):
+        if self._messages is None:
+            self._messages = self.chat.get_content()
+        return self._messages
+
+    def __len__(self):
+        if self._messages is not None:
+            return len(self._messages)
+        return self.chat.get_message_count()
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice) and self._messages is None:
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("Chat content slices do not support steps")
+            return self.chat.get_content(start, stop)
+        return self._load()[index]
+
+
 class ChatORM(db.Model):
     __tablename__ = "chats"
+    __table_args__ = (Index("ix_chats_owner_id_updated_at", "owner_id", "updated_at", "id"),)
     id = Column(Integer, primary_key=True)
     uuid = Column(String(36), default=lambda: str(uuid4()), unique=True, nullable=False)
     owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     preset_id = Column(Integer, ForeignKey("presets.id", ondelete="CASCADE"), nullable=False)
     title = Column(String(255), nullable=False)
-    content = Column(Text, nullable=False)
+    # Legacy JSON blob of the messages, NULL once the chat has been migrated to chat_messages
+    content = Column(Text, nullable=True)
+    message_count = Column(Integer, default=0, nullable=False)
+    last_message_preview = Column(String(255), nullable=True)
+    # Incremented on every change to the history, so ETags differ for writes within the same second
+    version = Column(Integer, default=0, server_default="0", nullable=False)
+    # Incremented only when the whole history is replaced, appends keep the existing messages and their summary valid
+    history_version = Column(Integer, default=0, server_default="0", nullable=False)
+    messages = relationship(
+        "ChatMessageORM",
+        lazy="dynamic",
+        order_by=ChatMessageORM.seq,
+        cascade="all, delete-orphan",
+        passive_deletes=True,
+    )
+    # Rolling summary of the messages with a seq below summary_upto
+    summary = Column(Text, nullable=True)
+    summary_upto = Column(Integer, default=0, nullable=False)
+    # Copy-on-write forks share the first fork_point messages of the parent chat and only store the messages after them
+    parent_id = Column(Integer, ForeignKey("chats.id", ondelete="SET NULL"), nullable=True, index=True)
+    fork_point = Column(Integer, default=0, nullable=False)
+    parent = relationship("ChatORM", remote_side=[id])
     task_id = Column(String(36), nullable=True)
     created_at = Column(DateTime, server_default=func.now())
-    updated_at = Column(DateTime, onupdate=func.now())
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
 
-    def to_dict(self):
-        content_obj = json.loads(self.content)
+    def to_dict(self, start=None, stop=None):
+        """
+        Serialize the chat. If start or stop is given, only the messages with an index in [start, stop) are loaded.
+        """
+        content = ChatContent(self)
+        if start is not None or stop is not None:
+            content = content[start:stop]
         return {
             "id": self.id,
             "uuid": self.uuid,
             "owner_id": self.owner_id,
             "preset_id": self.preset_id,
             "title": self.title,
-            "content": content_obj,
+            "content": content,
+            "message_count": self.get_message_count(),
             "created_at": self.created_at,
             "updated_at": self.updated_at
         }
-    
-    def get_content(self):
-        return json.loads(self.content)
-    
+
+    def to_summary(self):
+        return {
+            "id": self.id,
+            "uuid": self.uuid,
+            "preset_id": self.preset_id,
+            "title": self.title,
+            "message_count": self.message_count,
+            "last_message": self.last_message_preview,
+            "updated_at": self.updated_at,
+        }
+
+    def get_message_count(self):
+        if self.content is not None:
+            return len(json.loads(self.content))
+        return self.message_count
+
+    def get_content(self, start=None, stop=None):
+        """
+        Get the messages with an index in [start, stop) as a list of dicts.
+        """
+        if self.content is not None:
+            return json.loads(self.content)[start:stop]
+        self.check_fork()
+        start = start or 0
+        messages = []
+        if self.parent_id is not None and start < self.fork_point:
+            # The messages before the fork point are read from the parent
+            messages = self.parent.get_content(start, self.fork_point if stop is None else min(stop, self.fork_point))
+            start = self.fork_point
+        if stop is not None and stop <= start:
+            return messages
+        query = self.messages.filter(ChatMessageORM.seq >= start)
+        if stop is not None:
+            query = query.filter(ChatMessageORM.seq < stop)
+        return messages + [message.to_dict() for message in query]
+
+    def iter_recent_messages(self, batch_size=100, start=0):
+        """
+        Yield the messages of the chat with an index of at least start newest first, loading them in batches of batch_size.
+        """
+        if self.content is not None:
+            yield from reversed(json.loads(self.content)[start:])
+            return
+        stop = self.message_count
+        while stop > start:
+            batch_start = max(stop - batch_size, start)
+            yield from reversed(self.get_content(batch_start, stop))
+            stop = batch_start
+
+    def check_fork(self):
+        """
+        Make sure the messages a fork shares with its parent can still be read.
+        """
+        if self.parent_id is None and self.fork_point > 0:
+            raise Exception("Chat history is corrupt, the messages shared with its parent chat were lost")
+
+    def fork(self, owner_id):
+        """
+        Create a copy-on-write fork of the chat for another user. No messages are copied, the fork reads
+        the current history from this chat and stores only the messages added to it.
+        The shared chat stays locked until the caller commits, so it cannot be deleted or replaced before
+        detach_forks can see the fork. The caller is responsible for committing.
+        """
+        # Lock the parent before this chat, in the same order as detach_forks on the parent, and re-read both
+        # since a fork may have been detached after this chat was loaded
+        grandparent = None
+        if self.parent_id is not None:
+            grandparent = ChatORM.query.filter_by(id=self.parent_id).with_for_update().populate_existing().first()
+        ChatORM.query.filter_by(id=self.id).with_for_update().populate_existing().first()
+
+        parent, fork_point = self, self.get_message_count()
+        # A fork of a fork without messages of its own shares the same parent, keeping the chains short
+        if grandparent is not None and parent.parent_id == grandparent.id and parent.message_count == parent.fork_point:
+            parent = grandparent
+        fork = ChatORM(
+            owner_id=owner_id,
+            preset_id=self.preset_id,
+            title=self.title,
+            parent_id=parent.id,
+            fork_point=fork_point,
+            message_count=fork_point,
+            last_message_preview=self.last_message_preview,
+            # The summary only covers messages before summary_upto, which are all shared
+            summary=self.summary,
+            summary_upto=self.summary_upto,
+        )
+        db.session.add(fork)
+        db.session.flush()
+        return fork
+
+    def detach_forks(self):
+        """
+        Copy the shared messages into every fork of the chat, so its history can be deleted or replaced.
+        The chat stays locked until the caller commits, so no fork can be created from it in the meantime.
+        The caller is responsible for committing.
+        """
+        ChatORM.query.filter_by(id=self.id).with_for_update().populate_existing().first()
+        forks = ChatORM.query.filter_by(parent_id=self.id).with_for_update().all()
+        if not forks:
+            return
+        shared = self.get_content(0, max(fork.fork_point for fork in forks))
+        for fork in forks:
+            for seq, message in enumerate(shared[:fork.fork_point]):
+                db.session.add(ChatMessageORM.from_dict(fork.id, seq, message))
+            fork.parent_id = None
+            fork.fork_point = 0
+        db.session.flush()
+
     def add_message(self, message):
-        content_obj = json.loads(self.content)
-        content_obj.append(message)
-        self.content = json.dumps(content_obj)
+        self.add_messages([message])
+
+    def add_messages(self, messages):
+        """
+        Append messages to the end of the chat. Only the new rows are written.
+        The chat row is locked first, so concurrent appends cannot allocate the same message seq.
+        """
+        ChatORM.query.filter_by(id=self.id).with_for_update().populate_existing().first()
+        self.migrate_content()
+        seq = self.message_count
+        for message in messages:
+            db.session.add(ChatMessageORM.from_dict(self.id, seq, message))
+            seq += 1
+        self.message_count = seq
+        self.version = ChatORM.version + 1
+        if messages:
+            self.last_message_preview = get_message_preview(messages[-1])
         db.session.commit()
 
+    def replace_messages(self, messages):
+        """
+        Replace the whole history of the chat.
+        """
+        self.detach_forks()
+        self.parent_id = None
+        self.fork_point = 0
+        self.content = None
+        ChatMessageORM.query.filter_by(chat_id=self.id).delete(synchronize_session=False)
+        self.message_count = 0
+        self.last_message_preview = None
+        self.summary = None
+        self.summary_upto = 0
+        self.history_version = ChatORM.history_version + 1
+        self.add_messages(messages)
+
+    def migrate_content(self):
+        """
+        Move the legacy JSON blob into chat_messages. This is a no-op for migrated chats.
+        The caller is responsible for committing.
+        """
+        if self.content is None:
+            return
+        content_obj = json.loads(self.content)
+        ChatMessageORM.query.filter_by(chat_id=self.id).delete(synchronize_session=False)
+        for seq, message in enumerate(content_obj):
+            db.session.add(ChatMessageORM.from_dict(self.id, seq, message))
+        self.message_count = len(content_obj)
+        self.last_message_preview = get_message_preview(content_obj[-1]) if content_obj else None
+        self.content = None
+        db.session.flush()
+
+
+def migrate_legacy_chats(batch_size=100) -> int:
+    """
+    Migrate the legacy JSON blobs of up to batch_size chats and return how many were migrated.
+    Chats created before updated_at had a default get it backfilled from created_at, and every legacy chat gets
+    its message_count backfilled from the blob so chat listings are right before its messages are migrated.
+    """
+    ChatORM.query.filter(ChatORM.updated_at.is_(None)).update(
+        {ChatORM.updated_at: ChatORM.created_at}, synchronize_session=False
+    )
+    ChatORM.query.filter(ChatORM.content.isnot(None), ChatORM.message_count == 0).update(
+        {ChatORM.message_count: func.json_length(ChatORM.content)}, synchronize_session=False
+    )
+    chats = ChatORM.query.filter(ChatORM.content.isnot(None)).limit(batch_size).all()
+    for chat in chats:
+        chat.migrate_content()
+    db.session.commit()
+    return len(chats)
+
+
+def get_chat_tails(chats, limit) -> dict:
+    """
+    Load the last `limit` messages of several chats with a single query.
+    Messages a fork shares with its parent are read in the same query, the parents themselves are loaded with
+    one query per level of the fork chains.
+    Returns a dict mapping chat IDs to lists of message dicts.
+    """
+    tails = {}
+    # (chat ID, source chat, start, stop) for each range of a tail that still has to be located
+    pending = []
+    for chat in chats:
+        tails[chat.id] = []
+        if chat.content is not None:
+            tails[chat.id] = json.loads(chat.content)[-limit:]
+            continue
+        chat.check_fork()
+        pending.append((chat.id, chat, max(chat.message_count - limit, 0), chat.message_count))
+
+    # (chat ID, source chat ID, start, stop) for each range of a tail, and the messages of each source by seq
+    segments = []
+    messages = {}
+    conditions = []
+    parents = {}
+    while pending:
+        shared = []
+        for chat_id, source, start, stop in pending:
+            if source.content is not None:
+                # A legacy parent still stores its messages in the JSON blob
+                source_messages = messages.setdefault(source.id, {})
+                for seq, message in enumerate(json.loads(source.content)[start:stop], start):
+                    source_messages[seq] = message
+                segments.append((chat_id, source.id, start, stop))
+                continue
+            source.check_fork()
+            if source.parent_id is not None and start < source.fork_point:
+                # The messages before the fork point are read from the parent
+                shared.append((chat_id, source.parent_id, start, min(stop, source.fork_point)))
+                start = source.fork_point
+            if start < stop:
+                segments.append((chat_id, source.id, start, stop))
+                conditions.append(
+                    and_(ChatMessageORM.chat_id == source.id, ChatMessageORM.seq >= start, ChatMessageORM.seq < stop)
+                )
+
+        missing = {parent_id for _, parent_id, _, _ in shared if parent_id not in parents}
+        if missing:
+            parents.update((parent.id, parent) for parent in ChatORM.query.filter(ChatORM.id.in_(missing)))
+        pending = []
+        for chat_id, parent_id, start, stop in shared:
+            if parent_id not in parents:
+                raise Exception("Chat history is corrupt, the messages shared with its parent chat were lost")
+            pending.append((chat_id, parents[parent_id], start, stop))
+
+    if conditions:
+        for message in ChatMessageORM.query.filter(or_(*conditions)):
+            messages.setdefault(message.chat_id, {})[message.seq] = message.to_dict()
+    for chat_id, source_id, start, stop in sorted(segments, key=lambda segment: (segment[0], segment[2])):
+        source_messages = messages.get(source_id, {})
+        tails[chat_id].extend(source_messages[seq] for seq in range(start, stop) if seq in source_messages)
+    return tails
@@ -0,0 +1,41 @@
+from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean, ForeignKey, UniqueConstraint
+from sqlalchemy.sql import func
+from extensions import db
+from datetime import datetime
+
+
+class ChatMessageORM(db.Model):
+    __tablename__ = "chat_messages"
+    __table_args__ = (UniqueConstraint("chat_id", "seq", name="uq_chat_messages_chat_id_seq"),)
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"), nullable=False)
+    seq = Column(Integer, nullable=False)
+    type = Column(String(16), nullable=False, default="text")
+    role = Column(String(16), nullable=False)
+    content = Column(Text, nullable=False)
+    visible = Column(Boolean, nullable=False, default=True)
+    created_at = Column(DateTime, server_default=func.now())
+
+    @classmethod
+    def from_dict(cls, chat_id, seq, message):
+        created_at = message.get("created_at")
+        if isinstance(created_at, str):
+            created_at = datetime.fromisoformat(created_at)
+        return cls(
+            chat_id=chat_id,
+            seq=seq,
+            type=message.get("type", "text"),
+            role=message["role"],
+            content=message["content"],
+            visible=message.get("visible", True),
+            created_at=created_at or datetime.now(),
+        )
+
+    def to_dict(self):
+        return {
+            "type": self.type,
+            "role": self.role,
+            "content": self.content,
+            "visible": self.visible,
+            "created_at": self.created_at,
+        }
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean, ForeignKey
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from extensions import db
@@ -9,13 +9,15 @@ class PresetORM(db.Model):
     __tablename__ = "presets"
     id = Column(Integer, primary_key=True)
     uuid = Column(String(36), default=lambda: str(uuid4()), unique=True, nullable=False)
-    owner_id = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"), nullable=True)
+    owner_id = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"), nullable=True, index=True)
     name = Column(String(64), nullable=False)
     description = Column(String(255), nullable=True)
     avatar = Column(String(64), nullable=True)
     content = Column(Text, nullable=False)
     type = Column(String(64), nullable=False)
-    visibility = Column(String(16), nullable=False)
+    visibility = Column(String(16), nullable=False, index=True)
+    # Whether identical generation requests made with this preset may be answered from the result cache
+    cache_enabled = Column(Boolean, nullable=False, default=False)
     created_at = Column(DateTime, server_default=func.now())
     updated_at = Column(DateTime, onupdate=func.now())
 
@@ -31,6 +33,7 @@ class PresetORM(db.Model):
             "avatar": self.avatar,
             "content": content_obj,
             "visibility": self.visibility,
+            "cache_enabled": self.cache_enabled,
             "created_at": self.created_at,
             "updated_at": self.updated_at
         }
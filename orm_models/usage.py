@@ -8,4 +8,6 @@ class UsageORM(db.Model):
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     token_used = Column(Integer, nullable=False)
+    # "generation" for replies generated by the model, "cache" for replies served from the result cache
+    source = Column(String(16), nullable=False, default="generation")
     created_at = Column(DateTime, server_default=func.now())
\ No newline at end of file
@@ -1,9 +1,8 @@
 from sqlalchemy import Column, Integer, String, DateTime, Boolean
 from sqlalchemy.orm import relationship, column_property
-from sqlalchemy.sql import func, select
+from sqlalchemy.sql import func
 from werkzeug.security import generate_password_hash, check_password_hash
 from extensions import db
-from orm_models.usage import UsageORM
 
 
 class UserORM(db.Model):
@@ -20,12 +19,7 @@ class UserORM(db.Model):
     avatar = Column(String(64), nullable=True)
     is_deleted = Column(Boolean, default=False)
     total_credits = Column(Integer, default=0)
-    total_usage = column_property(
-        select(func.sum(UsageORM.token_used))
-        .where(UsageORM.user_id == id)
-        .correlate_except(UsageORM)
-        .scalar_subquery()
-    )
+    total_usage = Column(Integer, default=0, nullable=False)
     credits_left = column_property(total_credits - total_usage)
     created_at = Column(DateTime, server_default=func.now())
     updated_at = Column(DateTime, onupdate=func.now())
@@ -48,9 +42,3 @@ class UserORM(db.Model):
             "avatar": f"/users/{self.id}/avatar",
         }
 
-
-class TokenBlocklistORM(db.Model):
-    __tablename__ = "token_blocklist"
-    id = Column(Integer, primary_key=True)
-    jti = Column(String(36), nullable=False)
-    created_at = Column(DateTime, server_default=func.now())
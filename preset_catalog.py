@@ -0,0 +1,111 @@
+from flask import current_app
+from orm_models.preset import PresetORM
+from local_cache import LocalTTLCache
+from config import Config
+from datetime import datetime
+import json
+
+# Every cached catalog entry is keyed by the catalog version, so bumping the version invalidates all of them at once.
+# The version itself is cached locally for a short time only, which bounds how long other processes serve a stale catalog.
+_local_version = LocalTTLCache(max_size=1, ttl=Config.PRESET_CATALOG_VERSION_TTL)
+_local_catalog = LocalTTLCache(max_size=Config.PRESET_CATALOG_CACHE_SIZE, ttl=Config.PRESET_CATALOG_LOCAL_TTL)
+
+VERSION_KEY = "preset_catalog:version"
+
+
+def get_catalog_version() -> int:
+    version = _local_version.get(VERSION_KEY)
+    if version is None:
+        redis_client = current_app.config["REDIS_CLIENT"]
+        version = int(redis_client.get(VERSION_KEY) or 0)
+        _local_version.set(VERSION_KEY, version)
+    return version
+
+
+def bump_catalog_version():
+    """
+    Invalidate every cached preset list and document. Must be called after any preset is created, updated or deleted.
+    """
+    redis_client = current_app.config["REDIS_CLIENT"]
+    redis_client.incr(VERSION_KEY)
+    _local_version.clear()
+    _local_catalog.clear()
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _cached(name, load, decode=None):
+    """
+    Get a catalog entry from the local cache, then Redis, then `load()`. None results are not cached.
+    Datetimes are stored in ISO 8601 format, `decode` turns an entry read from Redis back into what `load()` returns.
+    """
+    key = f"preset_catalog:{get_catalog_version()}:{name}"
+    value = _local_catalog.get(key)
+    if value is not None:
+        return value
+
+    redis_client = current_app.config["REDIS_CLIENT"]
+    cached = redis_client.get(key)
+    if cached:
+        value = json.loads(cached)
+        if decode:
+            value = decode(value)
+    else:
+        value = load()
+        if value is None:
+            return None
+        redis_client.set(key, json.dumps(value, default=_encode_value), ex=Config.PRESET_CATALOG_TTL)
+    _local_catalog.set(key, value)
+    return value
+
+
+def get_preset_document(preset_uuid):
+    """
+    Get a preset as a dict, or None if it does not exist.
+    """
+    def load():
+        preset = PresetORM.query.filter_by(uuid=preset_uuid).first()
+        return preset.to_dict() if preset else None
+
+    def decode(preset):
+        for field in ("created_at", "updated_at"):
+            if preset[field] is not None:
+                preset[field] = datetime.fromisoformat(preset[field])
+        return preset
+
+    return _cached(f"preset:{preset_uuid}", load, decode)
+
+
+def _load_preset_ids(*criteria):
+    presets = PresetORM.query.with_entities(PresetORM.id, PresetORM.uuid).filter(*criteria).all()
+    return [[preset.id, preset.uuid] for preset in presets]
+
+
+def get_shared_preset_ids(visibility):
+    """
+    Get the [id, uuid] pairs of all presets with the given shared visibility (public or unlisted).
+    """
+    return _cached(visibility, lambda: _load_preset_ids(PresetORM.visibility == visibility))
+
+
+def get_owned_preset_ids(user_id):
+    """
+    Get the [id, uuid] pairs of all presets owned by a user.
+    """
+    return _cached(f"owned:{user_id}", lambda: _load_preset_ids(PresetORM.owner_id == user_id))
+
+
+def list_visible_preset_uuids(user):
+    """
+    Get the UUIDs of the presets listed for a user, ordered by ID.
+    Users see public and owned presets, admins also see unlisted presets.
+    """
+    presets = dict(get_shared_preset_ids("public"))
+    if user.permission_level > 1:
+        presets.update(get_shared_preset_ids("unlisted"))
+    presets.update(get_owned_preset_ids(user.id))
+    return [presets[preset_id] for preset_id in sorted(presets)]
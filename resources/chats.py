@@ -1,11 +1,30 @@
 from flask_jwt_extended import jwt_required, get_jwt, current_user
-from flask_restx import Resource, Namespace, marshal, reqparse
-from flask import send_file
+from flask_restx import Resource, Namespace, marshal, reqparse, inputs
+from flask import send_file, current_app
 from werkzeug.datastructures import FileStorage
-from models import message_model, chat_model, chat_list_model, chat_message_model
+from models import (
+    message_model,
+    chat_model,
+    chat_list_model,
+    chat_message_model,
+    append_messages_model,
+    chat_summary_model,
+    batch_get_model,
+    chat_batch_item_model,
+    chat_batch_model,
+)
 from orm_models.user import UserORM
-from orm_models.chat import ChatORM
+from orm_models.chat import ChatORM, get_chat_tails
+from orm_models.preset import PresetORM
 from extensions import db
+from sqlalchemy import or_, and_
+from sqlalchemy.orm import load_only, defer
+from datetime import datetime
+from utils import make_etag, conditional_headers, is_not_modified
+from idempotency import idempotent, IDEMPOTENCY_DOC
+from credit_ledger import reserve_credits
+from resources.tasks import get_writable_chat, claim_chat, release_chat, start_chat_task
+import json
 
 chats_namespace = Namespace("chats", description="Chat operations")
 
@@ -14,66 +33,171 @@ chat_parser.add_argument("preset_id", type=int, required=True, help="Preset ID o
 chat_parser.add_argument("title", type=str, required=True, help="Title of the chat.")
 chat_parser.add_argument("content", type=str, required=True, help="Content of the chat.")
 
+chat_window_parser = reqparse.RequestParser()
+chat_window_parser.add_argument("after", type=int, location="args", help="Only return messages with an index greater than this.")
+chat_window_parser.add_argument("before", type=int, location="args", help="Only return messages with an index less than this.")
+chat_window_parser.add_argument("limit", type=int, location="args", help="Maximum number of messages to return.")
+chat_window_parser.add_argument("tail", type=inputs.boolean, location="args", default=False, help="Return the last `limit` messages.")
+
+chat_list_parser = reqparse.RequestParser()
+chat_list_parser.add_argument("cursor", type=str, location="args", help="Cursor returned as `next_cursor` by the previous page.")
+chat_list_parser.add_argument("limit", type=int, location="args", help="Maximum number of chats to return.")
+
+batch_get_parser = reqparse.RequestParser()
+batch_get_parser.add_argument("uuids", type=list, location="json", required=True, help="UUIDs of the chats.")
+
+append_messages_parser = reqparse.RequestParser()
+append_messages_parser.add_argument("messages", type=list, location="json", required=True, help="Messages to append.")
+append_messages_parser.add_argument("generate", type=inputs.boolean, location="json", default=False, help="Start generating a reply.")
+
 chats_namespace.add_model("Chat", chat_model)
 chats_namespace.add_model("Message", message_model)
 chats_namespace.add_model("ChatList", chat_list_model)
+chats_namespace.add_model("ChatSummary", chat_summary_model)
+chats_namespace.add_model("BatchGet", batch_get_model)
+chats_namespace.add_model("ChatBatchItem", chat_batch_item_model)
+chats_namespace.add_model("ChatBatch", chat_batch_model)
 chats_namespace.add_model("ChatMessage", chat_message_model)
+chats_namespace.add_model("AppendMessages", append_messages_model)
+
+def get_message_window(args, total):
+    """
+    Translate the window arguments into a [start, stop) message range and the cursor of the next window.
+    Returns (None, None, None) if no window was requested.
+    """
+    if args["after"] is None and args["before"] is None and args["limit"] is None and not args["tail"]:
+        return None, None, None
+
+    limit = args["limit"] or current_app.config["CHAT_PAGE_SIZE"]
+    limit = min(max(limit, 1), current_app.config["CHAT_PAGE_MAX_SIZE"])
+    before = total if args["before"] is None else min(max(args["before"], 0), total)
+
+    if args["after"] is not None:
+        # Forward read, the next window continues after the last returned message
+        start = max(args["after"] + 1, 0)
+        stop = max(min(start + limit, before), start)
+        return start, stop, stop - 1 if start < stop < before else None
+
+    # Backward or tail read, the next window ends before the first returned message
+    start = max(before - limit, 0)
+    return start, before, start if start > 0 else None
+
+
+def validate_message(message):
+    """
+    Check a message sent by a client against the ChatMessage model. Returns an error message, or None if it is valid.
+    """
+    if not isinstance(message, dict):
+        return "Each message must be an object"
+    if message.get("type", "text") not in chat_message_model["type"].enum:
+        return f"type must be one of {', '.join(chat_message_model['type'].enum)}"
+    if message.get("role") not in chat_message_model["role"].enum:
+        return f"role must be one of {', '.join(chat_message_model['role'].enum)}"
+    if not isinstance(message.get("content"), str):
+        return "content must be a string"
+    if not isinstance(message.get("visible", True), bool):
+        return "visible must be a boolean"
+    created_at = message.get("created_at")
+    if created_at is not None:
+        try:
+            datetime.fromisoformat(created_at)
+        except (TypeError, ValueError):
+            return "created_at must be an ISO 8601 date time"
+    return None
+
+
+def parse_chat_content(content):
+    """
+    Parse and validate the JSON message list sent as the content of a chat. Returns the messages and an error message,
+    which is None if the content is valid.
+    """
+    try:
+        messages = json.loads(content)
+    except (TypeError, ValueError):
+        return None, "content must be a JSON array of messages"
+    if not isinstance(messages, list):
+        return None, "content must be a JSON array of messages"
+    for index, message in enumerate(messages):
+        error = validate_message(message)
+        if error:
+            return None, f"Invalid message {index}: {error}"
+    return messages, None
+
+
+def encode_chat_cursor(chat) -> str:
+    """
+    Encode the keyset position of a chat in the (updated_at, id) ordering.
+    Legacy rows get updated_at backfilled by migrate_legacy_chats, until then their creation time is used.
+    """
+    return f"{(chat.updated_at or chat.created_at).isoformat()}_{chat.id}"
+
+
+def decode_chat_cursor(cursor) -> tuple[datetime, int]:
+    updated_at, _, chat_id = cursor.rpartition("_")
+    return datetime.fromisoformat(updated_at), int(chat_id)
+
 
 @chats_namespace.route("/<string:chat_uuid>")
 class ChatResource(Resource):
 
     @jwt_required()
     @chats_namespace.doc(security="Bearer Auth")
+    @chats_namespace.expect(chat_window_parser)
     @chats_namespace.response(200, "Success", chat_model)
-    @chats_namespace.response(201, "Copy created", chat_model)
+    @chats_namespace.response(304, "Not modified")
     @chats_namespace.response(404, "Chat not found", message_model)
     def get(self, chat_uuid):
         """
         Get chat by UUID
         ---
-        ! Rteturn a copy of the chat if the user is not the owner
+        ! Chats of other users are shared read-only, the first write to one creates a copy for the user
+        The copy is a fork that shares the history of the original chat and only stores the messages added to it.
+        Writes that created a copy return its URL in the Chat-Location header.
+        Without window arguments the whole history is returned.
+        Use `after`/`before` (message indexes) with `limit`, or `tail` to read only a window of the history.
         """
-        chat = ChatORM.query.filter_by(uuid=chat_uuid).first()
+        args = chat_window_parser.parse_args()
+        chat = ChatORM.query.options(defer(ChatORM.content)).filter_by(uuid=chat_uuid).first()
 
         if not chat:
             return marshal({"message": "Chat not found"}, message_model), 404
-        
-        if chat.owner_id != current_user.id:
-            # If the user is not the dialog owner, make a copy of the chat
-            new_chat = ChatORM(
-                owner_id=current_user.id,
-                preset_id=chat.preset_id,
-                content=chat.content,
-            )
-            current_user.chats.append(new_chat)
-            db.session.commit()
-            return marshal(new_chat.to_dict(), chat_model), 201, {"Location": f"/chats/{new_chat.uuid}"}
-        
-        return marshal(chat.to_dict(), chat_model), 200
+
+        # The ETag covers the window arguments since they change the body
+        etag = make_etag(chat.id, chat.version, chat.updated_at, chat.message_count, args["after"], args["before"], args["limit"], args["tail"])
+        headers = conditional_headers(etag, chat.updated_at)
+        if is_not_modified(etag, chat.updated_at):
+            return "", 304, headers
+
+        start, stop, next_cursor = get_message_window(args, chat.get_message_count())
+        data = chat.to_dict(start, stop)
+        data["next_cursor"] = next_cursor
+        return marshal(data, chat_model), 200, headers
 
     @jwt_required()
     @chats_namespace.doc(security="Bearer Auth")
     @chats_namespace.expect(chat_parser)
     @chats_namespace.response(200, "Chat updated", message_model)
-    @chats_namespace.response(403, "Permission denied", message_model)
+    @chats_namespace.response(400, "Invalid message", message_model)
     @chats_namespace.response(404, "Chat not found", message_model)
     def put(self, chat_uuid):
         """
         Update chat by UUID
+        ---
+        ! Updating a chat of another user updates a copy of it, admins update the chat itself
         """
         data = chat_parser.parse_args()
+        messages, error = parse_chat_content(data["content"])
+        if error:
+            return marshal({"message": error}, message_model), 400
         chat = ChatORM.query.filter_by(uuid=chat_uuid).first()
 
         if not chat:
             return marshal({"message": "Chat not found"}, message_model), 404
-        
-        if chat.owner_id != current_user.id and current_user.permission_level < 2:
-            return marshal({"message": "You do not have permission to update this chat"}, message_model), 403
-        
+
+        chat, headers = get_writable_chat(chat, in_place=current_user.permission_level >= 2)
         chat.preset_id = data["preset_id"]
-        chat.content = data["content"]
-        db.session.commit()
-        return marshal({"message": "Chat updated successfully"}, message_model), 200
+        chat.replace_messages(messages)
+        return marshal({"message": "Chat updated successfully"}, message_model), 200, headers
 
     @jwt_required()
     @chats_namespace.doc(security="Bearer Auth")
@@ -91,42 +215,202 @@ class ChatResource(Resource):
         if chat.owner_id != current_user.id and current_user.permission_level < 2:
             return marshal({"message": "You do not have permission to delete this chat"}, message_model), 403
         
+        chat.detach_forks()
         db.session.delete(chat)
         db.session.commit()
         return marshal({"message": "Chat deleted"}, message_model), 200
 
 
+@chats_namespace.route("/<string:chat_uuid>/messages")
+class ChatMessagesResource(Resource):
+    @jwt_required()
+    @idempotent("chat_messages")
+    @chats_namespace.doc(security="Bearer Auth", params=IDEMPOTENCY_DOC)
+    @chats_namespace.expect(append_messages_model)
+    @chats_namespace.response(200, "Messages added", message_model)
+    @chats_namespace.response(201, "Messages added and task created", message_model)
+    @chats_namespace.response(400, "Invalid message", message_model)
+    @chats_namespace.response(402, "Insufficient credits", message_model)
+    @chats_namespace.response(404, "Chat not found", message_model)
+    @chats_namespace.response(409, "Task already exists", message_model)
+    def patch(self, chat_uuid):
+        """
+        Append messages to a chat
+        ---
+        Only the new messages are sent and written, unlike PUT /chats/<uuid> which replaces the whole history.
+        With `generate`, a task is started for the updated chat and its URL is returned in the Location header.
+        ! Messages sent to a chat of another user are appended to a copy of it, admins may append to the chat itself without `generate`
+        ! Nothing is appended while the chat has a task (409), since the reply would land after messages it never saw
+        ! With `generate`, nothing is appended if the user has no credits (402)
+        ! Retries with the same Idempotency-Key header get the first response and never append the messages twice
+        """
+        data = append_messages_parser.parse_args()
+        messages = data["messages"]
+        if not messages:
+            return marshal({"message": "At least one message is required"}, message_model), 400
+        for index, message in enumerate(messages):
+            error = validate_message(message)
+            if error:
+                return marshal({"message": f"Invalid message {index}: {error}"}, message_model), 400
+
+        chat = ChatORM.query.filter_by(uuid=chat_uuid).first()
+        if not chat:
+            return marshal({"message": "Chat not found"}, message_model), 404
+        preset = PresetORM.query.filter_by(id=chat.preset_id).first()
+        if data["generate"] and not preset:
+            return marshal({"message": "Preset not found"}, message_model), 404
+
+        chat, headers = get_writable_chat(chat, in_place=not data["generate"] and current_user.permission_level >= 2)
+        # Lock the chat so the task check below and the append or task claim are atomic
+        chat = ChatORM.query.filter_by(id=chat.id).with_for_update().populate_existing().first()
+
+        if not data["generate"]:
+            if chat.task_id is not None:
+                return marshal({"message": "The chat has a task, wait for it to finish before adding messages"}, message_model), 409, headers
+            chat.add_messages(messages)
+            return marshal({"message": "Messages added"}, message_model), 200, headers
+
+        # Claim the chat before appending, so a rejected request leaves the history unchanged
+        task_id = claim_chat(chat)
+        if task_id is None:
+            return marshal({"message": "The chat already has a task"}, message_model), 409, headers
+        if not reserve_credits(current_user.id, task_id):
+            release_chat(chat, task_id)
+            return marshal({"message": "You do not have enough credits, please purchase more credits"}, message_model), 402, headers
+
+        chat.add_messages(messages)
+        start_chat_task(chat, preset, task_id)
+        return marshal({"message": "Messages added and task created"}, message_model), 201, dict(headers, Location=f"/tasks/{task_id}")
+
+
 @chats_namespace.route("")
 class ChatsResource(Resource):
     @jwt_required()
-    @chats_namespace.doc(security="Bearer Auth")
+    @idempotent("chats")
+    @chats_namespace.doc(security="Bearer Auth", params=IDEMPOTENCY_DOC)
     @chats_namespace.response(200, "Success", chat_model)
+    @chats_namespace.response(400, "Invalid message", message_model)
     @chats_namespace.response(403, "Permission denied", message_model)
     def post(self):
         """
         Create a new chat
+        ---
+        ! Retries with the same Idempotency-Key header get the first response and never create a second chat
         """
         data = chat_parser.parse_args()
-        
+        messages, error = parse_chat_content(data["content"])
+        if error:
+            return marshal({"message": error}, message_model), 400
+
         chat = ChatORM(
             owner_id=current_user.id,
             preset_id=data["preset_id"],
             title=data["title"],
-            content=data["content"],
-        
         )
 
-        current_user.chats.append(chat)
-        db.session.commit()
+        db.session.add(chat)
+        db.session.flush()
+        chat.add_messages(messages)
         return marshal(chat.to_dict(), chat_model), 201, {"Location": f"/chats/{chat.uuid}"}
     
     
     @jwt_required()
     @chats_namespace.doc(security="Bearer Auth")
+    @chats_namespace.expect(chat_list_parser)
     @chats_namespace.response(200, "Success", chat_list_model)
+    @chats_namespace.response(304, "Not modified")
+    @chats_namespace.response(400, "Invalid cursor", message_model)
     def get(self):
         """
-        Get all chats of the user
+        Get the chats of the user, most recently updated first
+        ---
+        Results are paginated, pass `next_cursor` back as `cursor` to get the next page.
         """
-        chats = current_user.chats.all()
-        return marshal({"chat_ids": [chat.uuid for chat in chats]}, chat_list_model), 200
\ No newline at end of file
+        args = chat_list_parser.parse_args()
+        limit = args["limit"] or current_app.config["CHAT_LIST_PAGE_SIZE"]
+        limit = min(max(limit, 1), current_app.config["CHAT_LIST_PAGE_MAX_SIZE"])
+
+        query = ChatORM.query.options(
+            load_only(
+                ChatORM.id,
+                ChatORM.uuid,
+                ChatORM.preset_id,
+                ChatORM.title,
+                ChatORM.message_count,
+                ChatORM.last_message_preview,
+                ChatORM.version,
+                ChatORM.created_at,
+                ChatORM.updated_at,
+            )
+        ).filter(ChatORM.owner_id == current_user.id)
+
+        if args["cursor"]:
+            try:
+                updated_at, chat_id = decode_chat_cursor(args["cursor"])
+            except ValueError:
+                return marshal({"message": "Invalid cursor"}, message_model), 400
+            query = query.filter(
+                or_(
+                    ChatORM.updated_at < updated_at,
+                    and_(ChatORM.updated_at == updated_at, ChatORM.id < chat_id),
+                )
+            )
+
+        chats = query.order_by(ChatORM.updated_at.desc(), ChatORM.id.desc()).limit(limit + 1).all()
+        next_cursor = encode_chat_cursor(chats[limit - 1]) if len(chats) > limit else None
+        chats = chats[:limit]
+
+        etag = make_etag(args["cursor"], limit, *[f"{chat.id}@{chat.version}@{chat.updated_at}" for chat in chats])
+        headers = conditional_headers(etag)
+        if is_not_modified(etag):
+            return "", 304, headers
+
+        return marshal(
+            {
+                "chat_ids": [chat.uuid for chat in chats],
+                "chats": [chat.to_summary() for chat in chats],
+                "next_cursor": next_cursor,
+            },
+            chat_list_model,
+        ), 200, headers
+
+
+@chats_namespace.route(":batchGet")
+class ChatBatchResource(Resource):
+    @jwt_required()
+    @chats_namespace.doc(security="Bearer Auth")
+    @chats_namespace.expect(batch_get_model)
+    @chats_namespace.response(200, "Success", chat_batch_model)
+    @chats_namespace.response(400, "Too many UUIDs", message_model)
+    def post(self):
+        """
+        Get several chats by UUID
+        ---
+        Results are returned in request order, each with its own status.
+        Each chat only includes its latest messages, use GET /chats/<uuid> with `before` to read further back.
+        ! Chats owned by other users are not forked here, open them with GET /chats/<uuid> instead
+        """
+        data = batch_get_parser.parse_args()
+        uuids = data["uuids"]
+        if len(uuids) > current_app.config["BATCH_GET_MAX_ITEMS"]:
+            return marshal({"message": f"At most {current_app.config['BATCH_GET_MAX_ITEMS']} UUIDs can be requested at once"}, message_model), 400
+
+        chats = {chat.uuid: chat for chat in ChatORM.query.filter(ChatORM.uuid.in_(uuids)).all()}
+        limit = current_app.config["CHAT_PAGE_SIZE"]
+        tails = get_chat_tails([chat for chat in chats.values() if chat.owner_id == current_user.id], limit)
+
+        items = []
+        for chat_uuid in uuids:
+            chat = chats.get(chat_uuid)
+            if not chat:
+                items.append({"uuid": chat_uuid, "status": 404, "message": "Chat not found"})
+            elif chat.owner_id != current_user.id:
+                items.append({"uuid": chat_uuid, "status": 403, "message": "You are not the owner of this chat"})
+            else:
+                chat_data = chat.to_dict()
+                chat_data["content"] = tails[chat.id]
+                start = chat_data["message_count"] - len(tails[chat.id])
+                chat_data["next_cursor"] = start if start > 0 else None
+                items.append({"uuid": chat_uuid, "status": 200, "chat": chat_data})
+
+        return marshal({"items": items}, chat_batch_model), 200
@@ -1,12 +1,21 @@
 from flask_jwt_extended import jwt_required, get_jwt, current_user
-from flask_restx import Resource, Namespace, marshal, reqparse
-from flask import send_file
+from flask_restx import Resource, Namespace, marshal, reqparse, inputs
+from flask import send_file, current_app
 from werkzeug.datastructures import FileStorage
-from models import message_model, preset_model, preset_list_model
+from models import (
+    message_model,
+    preset_model,
+    preset_list_model,
+    batch_get_model,
+    preset_batch_item_model,
+    preset_batch_model,
+)
 from orm_models.chat import ChatORM
 from orm_models.preset import PresetORM
 from extensions import db
-from sqlalchemy import or_, and_
+from preset_catalog import get_preset_document, list_visible_preset_uuids, bump_catalog_version, get_catalog_version
+from utils import make_etag, conditional_headers, is_not_modified
+import json
 
 presets_namespace = Namespace("presets", description="Preset operations")
 
@@ -32,22 +41,60 @@ preset_parser.add_argument(
     help="Visibility of the preset. If the user is not an admin, the visibility will be set to unlisted if the user tries to set it to public.",
     choices=["public", "unlisted", "private"],
 )
+preset_parser.add_argument(
+    "cache_enabled",
+    type=inputs.boolean,
+    default=False,
+    help="Whether identical generation requests with the preset may be answered from the result cache.",
+)
+
+batch_get_parser = reqparse.RequestParser()
+batch_get_parser.add_argument("uuids", type=list, location="json", required=True, help="UUIDs of the presets.")
 
 presets_namespace.add_model("Preset", preset_model)
 presets_namespace.add_model("Message", message_model)
 presets_namespace.add_model("PresetList", preset_list_model)
+presets_namespace.add_model("BatchGet", batch_get_model)
+presets_namespace.add_model("PresetBatchItem", preset_batch_item_model)
+presets_namespace.add_model("PresetBatch", preset_batch_model)
+
+
+def can_view_preset(preset, user) -> bool:
+    """
+    Public and unlisted presets can be read by anyone who has their UUID, private presets only by their owner and admins.
+    """
+    if preset["visibility"] != "private":
+        return True
+    return preset["owner_id"] == user.id or user.permission_level >= 2
 
 
 @presets_namespace.route("/<string:preset_uuid>")
 class Preset(Resource):
-    @jwt_required
+    @jwt_required()
+    @presets_namespace.response(200, "Success", preset_model)
+    @presets_namespace.response(304, "Not modified")
+    @presets_namespace.response(403, "Permission denied", message_model)
+    @presets_namespace.response(404, "Preset not found", message_model)
     def get(self, preset_uuid):
-        preset = PresetORM.query.filter_by(uuid=preset_uuid).first()
+        """
+        Get a preset by UUID
+        """
+        preset = get_preset_document(preset_uuid)
         if not preset:
             return {"message": "Preset not found"}, 404
-        return marshal(preset, preset_model), 200
-
-    @jwt_required
+        if not can_view_preset(preset, current_user):
+            return {"message": "You do not have permission to view this preset"}, 403
+
+        # updated_at only has one-second precision, so the ETag is a hash of the body
+        data = marshal(preset, preset_model)
+        last_modified = preset["updated_at"] or preset["created_at"]
+        etag = make_etag(preset["id"], json.dumps(data, sort_keys=True))
+        headers = conditional_headers(etag, last_modified)
+        if is_not_modified(etag, last_modified):
+            return "", 304, headers
+        return data, 200, headers
+
+    @jwt_required()
     @presets_namespace.expect(preset_parser)
     @presets_namespace.response(200, "Presets updated", message_model)
     @presets_namespace.response(403, "Permission denied", message_model)
@@ -69,6 +116,7 @@ class Preset(Resource):
         preset.description = data["description"]
         preset.type = data["type"]
         preset.content = data["content"]
+        preset.cache_enabled = data["cache_enabled"]
 
         if data["visibility"] == "public" and current_user.permission_level < 2:
             preset.visibility = "unlisted"
@@ -76,9 +124,10 @@ class Preset(Resource):
             preset.visibility = data["visibility"]
 
         db.session.commit()
+        bump_catalog_version()
         return {"message": "Preset updated"}, 200
 
-    @jwt_required
+    @jwt_required()
     @presets_namespace.response(200, "Preset deleted", message_model)
     @presets_namespace.response(403, "Permission denied", message_model)
     @presets_namespace.response(404, "Preset not found", message_model)
@@ -102,14 +151,16 @@ class Preset(Resource):
         
         db.session.delete(preset)
         db.session.commit()
+        bump_catalog_version()
         return {"message": "Preset deleted"}, 200
 
 
 @presets_namespace.route("")
 class PresetList(Resource):
 
-    @jwt_required
+    @jwt_required()
     @presets_namespace.response(200, "Success", preset_list_model)
+    @presets_namespace.response(304, "Not modified")
     def get(self):
         """
         Get a list of all presets
@@ -118,19 +169,14 @@ class PresetList(Resource):
         For non-admin users, this will only return public and owned presets.
         For admin users, this will return public, unlisted, and owned presets.
         """
-        presets = PresetORM.query.filter(
-            or_(
-                PresetORM.owner_id == current_user.id,
-                PresetORM.visibility == "public",
-                and_(
-                    PresetORM.visibility == "unlisted",
-                    current_user.permission_level > 1,
-                ),
-            )
-        ).all()
-        return {"preset_ids": [preset.uuid for preset in presets]}, 200
-
-    @jwt_required
+        # The list only changes with the catalog version and the user's permission level
+        etag = make_etag(get_catalog_version(), current_user.id, current_user.permission_level)
+        headers = conditional_headers(etag)
+        if is_not_modified(etag):
+            return "", 304, headers
+        return {"preset_ids": list_visible_preset_uuids(current_user)}, 200, headers
+
+    @jwt_required()
     @presets_namespace.expect(preset_parser)
     @presets_namespace.response(201, "Preset created", message_model)
     def post(self):
@@ -150,11 +196,46 @@ class PresetList(Resource):
             type=data["type"],
             content=data["content"],
             visibility=visibility,
+            cache_enabled=data["cache_enabled"],
         )
-        current_user.owned_presets.append(preset)
+        db.session.add(preset)
         db.session.commit()
+        bump_catalog_version()
         return (
             {"message": "Preset created"},
             201,
             {"Location": f"/presets/{preset.uuid}"},
         )
+
+
+@presets_namespace.route(":batchGet")
+class PresetBatch(Resource):
+
+    @jwt_required()
+    @presets_namespace.expect(batch_get_model)
+    @presets_namespace.response(200, "Success", preset_batch_model)
+    @presets_namespace.response(400, "Too many UUIDs", message_model)
+    def post(self):
+        """
+        Get several presets by UUID
+        ---
+        Results are returned in request order, each with its own status.
+        """
+        data = batch_get_parser.parse_args()
+        uuids = data["uuids"]
+        if len(uuids) > current_app.config["BATCH_GET_MAX_ITEMS"]:
+            return {"message": f"At most {current_app.config['BATCH_GET_MAX_ITEMS']} UUIDs can be requested at once"}, 400
+
+        presets = {preset.uuid: preset.to_dict() for preset in PresetORM.query.filter(PresetORM.uuid.in_(uuids)).all()}
+
+        items = []
+        for preset_uuid in uuids:
+            preset = presets.get(preset_uuid)
+            if not preset:
+                items.append({"uuid": preset_uuid, "status": 404, "message": "Preset not found"})
+            elif not can_view_preset(preset, current_user):
+                items.append({"uuid": preset_uuid, "status": 403, "message": "You do not have permission to view this preset"})
+            else:
+                items.append({"uuid": preset_uuid, "status": 200, "preset": preset})
+
+        return marshal({"items": items}, preset_batch_model), 200
@@ -2,10 +2,11 @@ from flask_jwt_extended import create_access_token, create_refresh_token, jwt_re
 from flask_restx import Namespace, Resource, reqparse, marshal
 from flask import current_app
 from models import token_model, message_model
-from orm_models.user import UserORM, TokenBlocklistORM
+from orm_models.user import UserORM
 from extensions import db
 import requests
 from utils import generate_random_string, get_wechat_login_info, check_wechat_login_info
+from revocation import revoke_token
 
 session_namespace = Namespace("session", description="Session operations")
 login_parser = reqparse.RequestParser()
@@ -81,10 +82,7 @@ class SessionResource(Resource):
         !!! Refresh token required
         This will blacklist the user's refresh token
         """
-        jti = get_jwt()["jti"]
-        token = TokenBlocklistORM(jti=jti)
-        db.session.add(token)
-        db.session.commit()
+        revoke_token(get_jwt())
         return marshal({"message": "User logged out"}, message_model), 200
     
 @session_namespace.route("/wechat")
@@ -160,8 +158,5 @@ class WechatSessionResource(Resource):
         !!! Refresh token required
         This will blacklist the user's refresh token
         """
-        jti = get_jwt()["jti"]
-        token = TokenBlocklistORM(jti=jti)
-        db.session.add(token)
-        db.session.commit()
+        revoke_token(get_jwt())
         return marshal({"message": "User logged out"}, message_model), 200
\ No newline at end of file
@@ -1,25 +1,154 @@
 from flask_jwt_extended import jwt_required, get_jwt, current_user
 from flask_restx import Resource, Namespace, marshal, reqparse
+from flask import Response, current_app
 from orm_models.chat import ChatORM
 from orm_models.preset import PresetORM
-from models import message_model, task_model
+from models import message_model, task_model, limiter_scope_model, limiter_stats_model
 from extensions import db
 from celery.result import AsyncResult
-from tasks import ChatGenerationTask
+from tasks import GENERATION_MODEL, GENERATION_PARAMETERS, save_generation_result, save_generation_failure, resolve_follower
+from scheduler import submit_generation
+from single_flight import join_flight, leave_flight, finish_flight, get_flight_leader
+from result_cache import get_fingerprint
+from context_builder import build_context
+from credit_ledger import reserve_credits, release_credits
+from task_state import set_task_owner, get_task_owner, get_task_status, wait_for_task_status, request_task_cancel
+from streaming import get_chunk_hub, relay_task_stream, format_sse
+from generation_limiter import get_limiter_stats
+from idempotency import idempotent, IDEMPOTENCY_DOC
+from uuid import uuid4
+import time
 
 tasks_namespace = Namespace("tasks", description="Task operations")
 
 task_parser = reqparse.RequestParser()
 task_parser.add_argument("chat_id", type=str, required=True, help="Chat ID of the task.")
 
+task_status_parser = reqparse.RequestParser()
+task_status_parser.add_argument("wait", type=float, location="args", default=0, help="Seconds to wait for the task to finish.")
+
+stream_parser = reqparse.RequestParser()
+stream_parser.add_argument("offset", type=int, location="args", help="Resume after the event with this ID.")
+stream_parser.add_argument("Last-Event-ID", type=int, location="headers", dest="last_event_id", help="Resume after the event with this ID.")
+
+# Status of the final stream frame for each final task status
+FINAL_FRAME_STATUSES = {"SUCCESS": "success", "FAILURE": "error", "REVOKED": "cancelled"}
+
+# Seconds between checks while a follower of a cancelled flight is handed over to a new one
+HAND_OVER_POLL_INTERVAL = 0.1
+
 tasks_namespace.add_model("Task", task_model)
 tasks_namespace.add_model("Message", message_model)
+tasks_namespace.add_model("LimiterScope", limiter_scope_model)
+tasks_namespace.add_model("LimiterStats", limiter_stats_model)
+
+
+def get_writable_chat(chat, in_place=False):
+    """
+    Get the chat a write of the current user goes to. Chats of other users are shared read-only, so unless
+    `in_place` allows writing to them, the write goes to a copy-on-write fork created for the user.
+    Returns the chat and the headers that point the client to the fork, if one was created.
+    """
+    if chat.owner_id == current_user.id or in_place:
+        return chat, {}
+    fork = chat.fork(current_user.id)
+    db.session.commit()
+    return fork, {"Chat-Location": f"/chats/{fork.uuid}"}
+
+
+def claim_chat(chat):
+    """
+    Claim a chat for a new task with a compare-and-set, so concurrent requests cannot start two tasks.
+    Returns the new task ID, or None if the chat already has a task.
+    """
+    task_id = str(uuid4())
+    claimed = ChatORM.query.filter_by(id=chat.id, task_id=None).update(
+        {ChatORM.task_id: task_id}, synchronize_session=False
+    )
+    db.session.commit()
+    return task_id if claimed else None
+
+
+def release_chat(chat, task_id):
+    """
+    Undo claim_chat for a task that was not started.
+    """
+    ChatORM.query.filter_by(id=chat.id, task_id=task_id).update({ChatORM.task_id: None}, synchronize_session=False)
+    db.session.commit()
+
+
+def start_chat_task(chat, preset, task_id):
+    """
+    Start generating the reply of a claimed chat. Credits must already be reserved for the task.
+    If the task cannot be started, the chat and the credits are released before the error is raised.
+    """
+    try:
+        # Keep the preset, the summary of older messages and as many recent messages as fit in the token budget
+        messages = build_context(
+            preset.get_content(),
+            chat.iter_recent_messages(current_app.config["CONTEXT_BATCH_SIZE"], chat.summary_upto),
+            current_app.config["CONTEXT_TOKEN_BUDGET"],
+            chat.summary,
+        )
+
+        set_task_owner(task_id, current_user.id)
+
+        # An identical generation that is already running is shared instead of starting another one
+        fingerprint = get_fingerprint(GENERATION_MODEL, GENERATION_PARAMETERS, messages)
+        if join_flight(fingerprint, task_id, chat.id, messages, preset.cache_enabled) == task_id:
+            # The task waits in the user's queue until the fair-share scheduler sends it to a worker
+            submit_generation(current_user, task_id, chat.id, messages, preset.cache_enabled)
+    except Exception as e:
+        db.session.rollback()
+        release_chat(chat, task_id)
+        release_credits(current_user.id, task_id)
+        # Leave the flight the task may have joined, requests that joined it in the meantime fail with it
+        leave_flight(task_id)
+        for follower in finish_flight(task_id):
+            resolve_follower(save_generation_failure, follower["chat_id"], follower["task_id"], e)
+        raise
+
+
+def wait_for_hand_over(task_id, leader_id, timeout):
+    """
+    Wait until a follower task whose leader was cancelled has been handed over to a new flight.
+    Returns the ID of the task the follower's output is now streamed from, or None if the follower finished
+    or was not handed over within `timeout` seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if get_task_status(task_id) is not None:
+            return None
+        stream_task_id = get_flight_leader(task_id) or task_id
+        if stream_task_id != leader_id:
+            return stream_task_id
+        time.sleep(HAND_OVER_POLL_INTERVAL)
+    return None
+
+
+@tasks_namespace.route("/limiter")
+class TaskLimiter(Resource):
+
+    @jwt_required()
+    @tasks_namespace.response(200, "Success", limiter_stats_model)
+    @tasks_namespace.response(403, "Permission denied", message_model)
+    def get(self):
+        """
+        Get the generation admission control statistics
+        ---
+        ! Admin only. Shows in-flight and queued generations and slot wait times per model and API key
+        """
+        if current_user.permission_level < 2:
+            return marshal({"message": "Permission denied"}, message_model), 403
+        stats = get_limiter_stats(current_app.config["REDIS_CLIENT"])
+        return marshal({"scopes": stats}, limiter_stats_model), 200
 
 
 @tasks_namespace.route("/<string:task_uuid>")
 class Task(Resource):
     
-    @jwt_required
+    @jwt_required()
+    @tasks_namespace.expect(task_status_parser)
     @tasks_namespace.response(200, "Success", task_model)
     @tasks_namespace.response(404, "Task not found", message_model)
     def get(self, task_uuid):
@@ -27,14 +156,28 @@ class Task(Resource):
         Retrieve a task by UUID
         ---
         ! If the task is in SUCCESS or FAILURE status, the result will be included in the response
+        With `wait`, the request is held for up to that many seconds until the task finishes,
+        so clients can long-poll instead of polling repeatedly.
         """
-        task = AsyncResult(task_uuid)
+        args = task_status_parser.parse_args()
+        wait = min(max(args["wait"] or 0, 0), current_app.config["TASK_WAIT_MAX"])
+
+        status = get_task_status(task_uuid)
+        if status is None and wait > 0:
+            # Do not keep a database connection checked out while waiting
+            db.session.close()
+            status = wait_for_task_status(task_uuid, wait)
+        if status is not None:
+            return marshal(status, task_model), 200
+
+        # Followers of a single flight report the status of their leader until their reply is saved
+        task = AsyncResult(get_flight_leader(task_uuid) or task_uuid)
 
         if not task:
             return {"message": "Task not found"}, 404
         
         status = {
-            "id": task.id,
+            "id": task_uuid,
             "status": task.status,
         }
 
@@ -43,32 +186,127 @@ class Task(Resource):
 
         return marshal(status, task_model), 200
     
-    @jwt_required
+    @jwt_required()
+    @tasks_namespace.response(200, "Task cancelled", message_model)
+    @tasks_namespace.response(403, "Permission denied", message_model)
+    @tasks_namespace.response(404, "Task not found", message_model)
     def delete(self, task_uuid):
         """
-        Delete a task by UUID
+        Cancel a task by UUID
         ---
-        ! This will revoke and forget the task
+        ! The worker stops generating at the next check, saves the partial reply to the chat and only bills what was generated
         """
-        task = AsyncResult(task_uuid)
+        owner_id = get_task_owner(task_uuid)
+        if owner_id is None:
+            return marshal({"message": "Task not found"}, message_model), 404
+        if owner_id != current_user.id:
+            return marshal({"message": "You are not the owner of the task"}, message_model), 403
 
-        if not task:
-            return {"message": "Task not found"}, 404
-        
-        task.revoke(terminate=True)
-        task.forget()
+        # A follower of a single flight is detached, the leader keeps generating for the other requests
+        follower = leave_flight(task_uuid)
+        if follower is not None:
+            save_generation_result(follower["chat_id"], task_uuid, "", cancelled=True)
+        else:
+            request_task_cancel(task_uuid)
 
-        return {"message": "Task deleted"}, 200
+        return marshal({"message": "Task cancelled"}, message_model), 200
     
 
+@tasks_namespace.route("/<string:task_uuid>/stream")
+class TaskStream(Resource):
+
+    @jwt_required()
+    @tasks_namespace.expect(stream_parser)
+    @tasks_namespace.produces(["text/event-stream"])
+    @tasks_namespace.response(200, "Event stream")
+    @tasks_namespace.response(403, "Permission denied", message_model)
+    @tasks_namespace.response(404, "Task not found", message_model)
+    def get(self, task_uuid):
+        """
+        Stream the output of a task as Server-Sent Events
+        ---
+        Each `in_progress` event carries the next chunk of the reply.
+        The stream ends with a `success` event carrying the full reply, a `cancelled` event carrying the partial reply,
+        or an `error` event.
+        Events carry sequential IDs. With the Redis Streams transport, clients can resume an interrupted stream
+        by sending the last ID they received as the `Last-Event-ID` header or the `offset` argument.
+        ! A task that shares an identical generation started by another request is not cancelled with it. The reply is
+        generated again and the stream sends a `restarted` event with ID 0, clients must drop the partial reply
+        """
+        args = stream_parser.parse_args()
+        offset = args["last_event_id"] or args["offset"] or 0
+
+        owner_id = get_task_owner(task_uuid)
+        if owner_id is None:
+            return marshal({"message": "Task not found"}, message_model), 404
+        if owner_id != current_user.id:
+            return marshal({"message": "You are not the owner of the task"}, message_model), 403
+
+        # Do not keep a database connection checked out for the lifetime of the stream
+        db.session.close()
+
+        # Finished tasks are answered with their final frame only
+        status = get_task_status(task_uuid)
+        if status is not None:
+            frame = {"status": FINAL_FRAME_STATUSES[status["status"]], "content": status["result"]}
+            return Response(format_sse(frame), mimetype="text/event-stream")
+        stream_task_id = get_flight_leader(task_uuid) or task_uuid
+        task = AsyncResult(stream_task_id)
+        if task.status == "SUCCESS":
+            frame = {"status": "success", "content": task.result}
+            return Response(format_sse(frame), mimetype="text/event-stream")
+        if task.status == "FAILURE":
+            frame = {"status": "error", "content": str(task.result)}
+            return Response(format_sse(frame), mimetype="text/event-stream")
+
+        hub = get_chunk_hub(current_app.config["REDIS_CLIENT"])
+        subscription = hub.subscribe(stream_task_id, offset)
+        heartbeat_interval = current_app.config["STREAM_HEARTBEAT_INTERVAL"]
+        timeout = current_app.config["STREAM_TIMEOUT"]
+        # The stream runs after the request has returned, the hand-over checks need an app context of their own
+        app = current_app._get_current_object()
+
+        def stream():
+            leader_id, leader_subscription = stream_task_id, subscription
+            while True:
+                # Followers hold back the cancellation of their leader, they are handed over to a new flight
+                hold = ("cancelled",) if leader_id != task_uuid else ()
+                try:
+                    held = yield from relay_task_stream(leader_subscription, heartbeat_interval, timeout, hold)
+                finally:
+                    hub.unsubscribe(leader_id, leader_subscription)
+                if held is None:
+                    return
+
+                with app.app_context():
+                    next_leader_id = wait_for_hand_over(task_uuid, leader_id, heartbeat_interval)
+                    status = get_task_status(task_uuid) if next_leader_id is None else None
+                if next_leader_id is None:
+                    if status is not None:
+                        held = {"status": FINAL_FRAME_STATUSES[status["status"]], "content": status["result"]}
+                    yield format_sse(held, held.get("seq"))
+                    return
+
+                # The reply is generated again from the start, the event ID is reset for the new stream
+                yield format_sse({"status": "restarted", "content": ""}, 0)
+                leader_id, leader_subscription = next_leader_id, hub.subscribe(next_leader_id, 0)
+
+        return Response(
+            stream(),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+
 @tasks_namespace.route("")
 class TaskList(Resource):
 
-    @jwt_required
+    @jwt_required()
+    @idempotent("tasks")
+    @tasks_namespace.doc(params=IDEMPOTENCY_DOC)
     @tasks_namespace.expect(task_parser)
     @tasks_namespace.response(201, "Task created", message_model)
     @tasks_namespace.response(402, "Insufficient credits", message_model)
-    @tasks_namespace.response(403, "Permission denied", message_model)
     @tasks_namespace.response(404, "Chat not found", message_model)
     @tasks_namespace.response(409, "Task already exists", message_model)
     def post(self):
@@ -78,6 +316,8 @@ class TaskList(Resource):
         ! Update the chat with user's input before creating a task
         ! If the chat already has a task, return 409
         ! If the user does not have enough credits, return 402
+        ! A task for a chat of another user runs on a copy of the chat, whose URL is returned in the Chat-Location header
+        ! Retries with the same Idempotency-Key header get the first response and never start a second task
         This will start a new task to generate a chat based on the preset and chat content.
         The task will be added to the chat and the chat will be updated with the result.
         """
@@ -91,20 +331,15 @@ class TaskList(Resource):
         if not preset:
             return marshal({"message": "Preset not found"}, message_model), 404
         
-        if chat.owner_id != current_user.id:
-            return marshal({"message": "You are not the owner of the chat"}, message_model), 403
-        if current_user.credits <= 0:
-            return marshal({"message": "You do not have enough credits, please purchase more credits"}, message_model), 402
-        
-        if chat.task_id:
-            return marshal({"message": "The chat already has a task"}, message_model), 409
-        
-        preset_messages = [{"role": message.role, "content": message.content} for message in preset.get_content()]
-        chat_messages = [{"role": message.role, "content": message.content} for message in chat.get_content()]
-        messages = preset_messages + chat_messages
+        chat, headers = get_writable_chat(chat)
+
+        task_id = claim_chat(chat)
+        if task_id is None:
+            return marshal({"message": "The chat already has a task"}, message_model), 409, headers
 
-        task = ChatGenerationTask.apply_async(args=(chat.id, messages))
-        chat.task_id = task.id
-        db.session.commit()
+        if not reserve_credits(current_user.id, task_id):
+            release_chat(chat, task_id)
+            return marshal({"message": "You do not have enough credits, please purchase more credits"}, message_model), 402, headers
 
-        return marshal({"message": "Task created"}, message_model), 201, {"Location": f"/tasks/{task.id}"}
+        start_chat_task(chat, preset, task_id)
+        return marshal({"message": "Task created"}, message_model), 201, dict(headers, Location=f"/tasks/{task_id}")
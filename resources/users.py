@@ -5,6 +5,9 @@ from werkzeug.datastructures import FileStorage
 from models import user_model, users_list_model, message_model
 from orm_models.user import UserORM
 from extensions import db
+from identity import invalidate_user_identity
+from utils import save_avatar, make_etag, conditional_headers, is_not_modified
+import json
 
 users_namespace = Namespace("users", description="User operations")
 
@@ -46,6 +49,7 @@ class UserResource(Resource):
     @jwt_required()
     @users_namespace.doc(security="Bearer Auth")
     @users_namespace.response(200, "Success", user_model)
+    @users_namespace.response(304, "Not modified")
     @users_namespace.response(403, "Permission denied", message_model)
     @users_namespace.response(404, "User not found", message_model)
     def get(self, user_id):
@@ -57,7 +61,15 @@ class UserResource(Resource):
             return marshal({"message": "User not found"}, message_model), 404
         if user_id != current_user.id and current_user.permission_level < 2:
             return marshal({"message": "Permission denied"}, message_model), 403
-        return marshal(user.to_dict(), user_model), 200
+
+        # updated_at only has one-second precision, so the ETag is a hash of the body
+        data = marshal(user.to_dict(), user_model)
+        last_modified = user.updated_at or user.created_at
+        etag = make_etag(user.id, json.dumps(data, sort_keys=True))
+        headers = conditional_headers(etag, last_modified)
+        if is_not_modified(etag, last_modified):
+            return "", 304, headers
+        return data, 200, headers
 
     @jwt_required()
     @users_namespace.doc(security="Bearer Auth")
@@ -83,6 +95,7 @@ class UserResource(Resource):
 
         user.is_deleted = True
         db.session.commit()
+        invalidate_user_identity(user.id)
         return marshal({"message": "User deleted successfully"}, message_model), 200
 
     @jwt_required()
@@ -151,6 +164,7 @@ class UserResource(Resource):
             user.set_password(data["password"])
 
         db.session.commit()
+        invalidate_user_identity(user.id)
         return marshal({"message": "User updated successfully"}, message_model), 200
 
 
@@ -178,9 +192,11 @@ class UserAvatarResource(Resource):
             return marshal({"message": "Permission denied"}, message_model), 403
 
         avatar = data["file"]
-
+        if avatar:
+            user.avatar = save_avatar(avatar)
 
         db.session.commit()
+        invalidate_user_identity(user.id)
 
         return marshal({"message": "Avatar uploaded successfully"}, message_model), 200
 
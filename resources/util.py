@@ -2,6 +2,9 @@ from flask_restx import Resource, Namespace, marshal, reqparse
 from flask_sqlalchemy import SQLAlchemy
 from flask import current_app
 from orm_models.user import UserORM
+from orm_models.chat import migrate_legacy_chats
+from revocation import migrate_token_blocklist
+from credit_ledger import migrate_credit_ledger
 from models import message_model
 from extensions import db
 
@@ -36,4 +39,41 @@ class Drop(Resource):
         Drop database.
         """
         db.drop_all()
-        return marshal({"message": "Database dropped"}, message_model), 200
\ No newline at end of file
+        return marshal({"message": "Database dropped"}, message_model), 200
+
+@util_namespace.route("/migrate-chats")
+class MigrateChats(Resource):
+    @util_namespace.response(200, "Success", message_model)
+    def get(self):
+        """
+        Move legacy chat content blobs into the chat_messages table.
+        """
+        migrated = 0
+        while True:
+            count = migrate_legacy_chats()
+            if count == 0:
+                break
+            migrated += count
+        return marshal({"message": f"{migrated} chats migrated"}, message_model), 200
+
+
+@util_namespace.route("/migrate-revocations")
+class MigrateRevocations(Resource):
+    @util_namespace.response(200, "Success", message_model)
+    def get(self):
+        """
+        Copy the revoked tokens of the legacy token_blocklist table into Redis and drop the table.
+        """
+        migrated = migrate_token_blocklist()
+        return marshal({"message": f"{migrated} revoked tokens migrated"}, message_model), 200
+
+
+@util_namespace.route("/migrate-credits")
+class MigrateCredits(Resource):
+    @util_namespace.response(200, "Success", message_model)
+    def get(self):
+        """
+        Add the users' usage counter column if it is missing and backfill it from the usages table.
+        """
+        backfilled = migrate_credit_ledger()
+        return marshal({"message": f"{backfilled} users backfilled"}, message_model), 200
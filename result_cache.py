@@ -0,0 +1,69 @@
+from flask import current_app
+from config import Config
+import hashlib
+import json
+import time
+
+# Exact-match cache of generated replies, for presets that opt in.
+# Entries are keyed by a hash of the model, the request parameters and the messages, expire after
+# RESULT_CACHE_TTL seconds, and the least recently used entries are evicted beyond RESULT_CACHE_MAX_ENTRIES.
+
+LRU_KEY = "result_cache:lru"
+
+# Size of the pieces a cached reply is replayed in, the coalescer groups them into frames
+REPLAY_PIECE_LENGTH = 64
+
+
+def _entry_key(fingerprint) -> str:
+    return f"result_cache:{fingerprint}"
+
+
+def get_fingerprint(model, parameters: dict, messages: list) -> str:
+    """
+    Get the cache key of a generation request. Equal requests always give equal keys.
+    """
+    canonical = json.dumps(
+        {"model": model, "parameters": parameters, "messages": messages},
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def get_cached_result(fingerprint):
+    """
+    Get the cached reply of a request, or None on a miss.
+    """
+    redis_client = current_app.config["REDIS_CLIENT"]
+    content = redis_client.get(_entry_key(fingerprint))
+    if content is not None:
+        redis_client.zadd(LRU_KEY, {fingerprint: time.time()})
+    return content
+
+
+def store_result(fingerprint, content):
+    """
+    Cache the reply of a request and evict the least recently used entries beyond the size limit.
+    """
+    redis_client = current_app.config["REDIS_CLIENT"]
+    pipeline = redis_client.pipeline()
+    pipeline.set(_entry_key(fingerprint), content, ex=Config.RESULT_CACHE_TTL)
+    pipeline.zadd(LRU_KEY, {fingerprint: time.time()})
+    pipeline.zcard(LRU_KEY)
+    size = pipeline.execute()[-1]
+
+    if size > Config.RESULT_CACHE_MAX_ENTRIES:
+        evicted = redis_client.zpopmin(LRU_KEY, size - Config.RESULT_CACHE_MAX_ENTRIES)
+        if evicted:
+            redis_client.delete(*[_entry_key(fingerprint) for fingerprint, _ in evicted])
+
+
+def replay_result(coalescer, content):
+    """
+    Feed a cached reply through the coalescer, so clients receive it like a generated one.
+    """
+    for start in range(0, len(content), REPLAY_PIECE_LENGTH):
+        coalescer.add(content[start:start + REPLAY_PIECE_LENGTH])
+    coalescer.flush()
@@ -0,0 +1,88 @@
+from flask import current_app
+from sqlalchemy import MetaData, Table, inspect, select
+from extensions import db
+from local_cache import LocalTTLCache
+from config import Config
+from datetime import datetime
+import time
+
+# Local view of the revocation store. Revoked JTIs stay cached until the token expires,
+# JTIs that were found not to be revoked are cached for a short time only so that
+# a logout in another worker process becomes visible quickly.
+_local_revocations = LocalTTLCache(
+    max_size=Config.JWT_REVOCATION_CACHE_SIZE,
+    ttl=Config.JWT_REVOCATION_NEGATIVE_TTL,
+)
+
+
+def _revocation_key(jti) -> str:
+    return f"revoked_token:{jti}"
+
+
+def _seconds_until_expiry(jwt_data) -> int:
+    """
+    Get the remaining lifetime of a token in seconds, falling back to the configured default for tokens without `exp`.
+    """
+    if "exp" not in jwt_data:
+        return Config.JWT_REVOCATION_DEFAULT_TTL
+    return max(int(jwt_data["exp"] - time.time()), 1)
+
+
+def revoke_token(jwt_data):
+    """
+    Record a token as revoked in Redis until it expires.
+    """
+    jti = jwt_data["jti"]
+    ttl = _seconds_until_expiry(jwt_data)
+    redis_client = current_app.config["REDIS_CLIENT"]
+    redis_client.set(_revocation_key(jti), 1, ex=ttl)
+    _local_revocations.set(jti, True, ttl=ttl)
+
+
+def is_token_revoked(jwt_data) -> bool:
+    """
+    Check whether a token has been revoked. The local cache answers repeated checks without a Redis round trip.
+    """
+    jti = jwt_data["jti"]
+    revoked = _local_revocations.get(jti)
+    if revoked is not None:
+        return revoked
+
+    redis_client = current_app.config["REDIS_CLIENT"]
+    revoked = bool(redis_client.exists(_revocation_key(jti)))
+    if revoked:
+        _local_revocations.set(jti, True, ttl=_seconds_until_expiry(jwt_data))
+    else:
+        _local_revocations.set(jti, False)
+    return revoked
+
+
+def migrate_token_blocklist() -> int:
+    """
+    Copy the still-unexpired JTIs of the legacy token_blocklist table into the revocation store, then drop the table.
+    Only refresh tokens were ever blocklisted, so each one is revoked until its creation time plus the refresh token lifetime.
+    Returns the number of JTIs copied.
+    """
+    if not inspect(db.engine).has_table("token_blocklist"):
+        return 0
+    token_blocklist = Table("token_blocklist", MetaData(), autoload_with=db.engine)
+
+    refresh_expires = current_app.config.get("JWT_REFRESH_TOKEN_EXPIRES")
+    lifetime = refresh_expires.total_seconds() if refresh_expires else Config.JWT_REVOCATION_DEFAULT_TTL
+    now = datetime.now()
+
+    redis_client = current_app.config["REDIS_CLIENT"]
+    pipeline = redis_client.pipeline()
+    migrated = 0
+    for jti, created_at in db.session.execute(select(token_blocklist.c.jti, token_blocklist.c.created_at)):
+        ttl = int(lifetime - (now - created_at).total_seconds()) if created_at else int(lifetime)
+        if ttl <= 0:
+            continue
+        pipeline.set(_revocation_key(jti), 1, ex=ttl)
+        migrated += 1
+    pipeline.execute()
+    db.session.commit()
+
+    # The table is only dropped once every revocation is in Redis
+    token_blocklist.drop(db.engine)
+    return migrated
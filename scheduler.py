@@ -0,0 +1,169 @@
+from flask import current_app
+from extensions import celery_app
+from config import Config
+import json
+import time
+
+# Fair-share scheduling of generation tasks.
+# Submitted tasks wait in a Redis list per user and are only sent to the workers when a slot is free.
+# Users with queued tasks are kept in a ZSET scored by their virtual pass. Dispatching always serves the
+# eligible user with the lowest pass and advances it by 1 / weight, where the weight comes from the user's
+# permission level (stride scheduling). Users under their in-flight cap are eligible, and at most
+# SCHEDULER_MAX_IN_FLIGHT tasks run at once.
+
+READY_KEY = "sched:ready"
+PASSES_KEY = "sched:passes"
+WEIGHTS_KEY = "sched:weights"
+VIRTUAL_TIME_KEY = "sched:vtime"
+IN_FLIGHT_KEY = "sched:in_flight"
+RUNNING_KEY = "sched:running"
+RUNNING_USERS_KEY = "sched:running_users"
+
+
+def _queue_key(user_id) -> str:
+    return f"sched:queue:{user_id}"
+
+
+def _payload_key(task_id) -> str:
+    return f"sched:task:{task_id}"
+
+
+# Queue a task for a user. A user who becomes active starts at the current virtual time,
+# so idle time cannot be banked to starve other users later.
+SUBMIT_SCRIPT = """
+local queue, ready, passes, weights, vtime = KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5]
+local user_id, task_id, weight = ARGV[1], ARGV[2], ARGV[3]
+
+redis.call('RPUSH', queue, task_id)
+redis.call('HSET', weights, user_id, weight)
+if not redis.call('ZSCORE', ready, user_id) then
+    local pass = math.max(tonumber(redis.call('HGET', passes, user_id) or 0), tonumber(redis.call('GET', vtime) or 0))
+    redis.call('ZADD', ready, pass, user_id)
+end
+return redis.call('LLEN', queue)
+"""
+
+# Pick the tasks to send to the workers. Running tasks older than the running TTL are assumed lost and reclaimed.
+DISPATCH_SCRIPT = """
+local ready, passes, weights, vtime, in_flight, running, running_users = KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5], KEYS[6], KEYS[7]
+local now, max_total, max_user, running_ttl = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+
+for _, task_id in ipairs(redis.call('ZRANGEBYSCORE', running, '-inf', now - running_ttl)) do
+    local user_id = redis.call('HGET', running_users, task_id)
+    redis.call('ZREM', running, task_id)
+    redis.call('HDEL', running_users, task_id)
+    if user_id then
+        redis.call('HINCRBY', in_flight, user_id, -1)
+    end
+end
+
+local dispatched = {}
+local total = redis.call('ZCARD', running)
+while total < max_total do
+    local user_id, pass
+    local candidates = redis.call('ZRANGE', ready, 0, -1, 'WITHSCORES')
+    for i = 1, #candidates, 2 do
+        if tonumber(redis.call('HGET', in_flight, candidates[i]) or 0) < max_user then
+            user_id, pass = candidates[i], tonumber(candidates[i + 1])
+            break
+        end
+    end
+    if not user_id then
+        break
+    end
+
+    local queue = 'sched:queue:' .. user_id
+    local task_id = redis.call('LPOP', queue)
+    if task_id then
+        local next_pass = pass + 1 / tonumber(redis.call('HGET', weights, user_id) or 1)
+        redis.call('SET', vtime, pass)
+        redis.call('ZADD', running, now, task_id)
+        redis.call('HSET', running_users, task_id, user_id)
+        redis.call('HINCRBY', in_flight, user_id, 1)
+        table.insert(dispatched, task_id)
+        total = total + 1
+        if redis.call('LLEN', queue) > 0 then
+            redis.call('ZADD', ready, next_pass, user_id)
+        else
+            redis.call('ZREM', ready, user_id)
+            redis.call('HSET', passes, user_id, next_pass)
+        end
+    else
+        redis.call('ZREM', ready, user_id)
+    end
+end
+return dispatched
+"""
+
+# Free the slot of a finished task. Returns 0 if the task was not running, so a slot is never freed twice.
+COMPLETE_SCRIPT = """
+local in_flight, running, running_users = KEYS[1], KEYS[2], KEYS[3]
+local user_id = redis.call('HGET', running_users, ARGV[1])
+if not user_id then
+    return 0
+end
+redis.call('HDEL', running_users, ARGV[1])
+redis.call('ZREM', running, ARGV[1])
+redis.call('HINCRBY', in_flight, user_id, -1)
+return 1
+"""
+
+
+def get_user_weight(permission_level) -> float:
+    weights = Config.SCHEDULER_LEVEL_WEIGHTS
+    return float(weights.get(str(permission_level), 1))
+
+
+def submit_generation(user, task_id, chat_id, messages, use_cache=False):
+    """
+    Queue a generation task for a user and dispatch whatever can run now.
+    """
+    redis_client = current_app.config["REDIS_CLIENT"]
+    redis_client.set(
+        _payload_key(task_id),
+        json.dumps({"chat_id": chat_id, "messages": messages, "use_cache": use_cache}, default=str),
+        ex=Config.TASK_STATE_TTL,
+    )
+    submit = redis_client.register_script(SUBMIT_SCRIPT)
+    submit(
+        keys=[_queue_key(user.id), READY_KEY, PASSES_KEY, WEIGHTS_KEY, VIRTUAL_TIME_KEY],
+        args=[user.id, task_id, get_user_weight(user.permission_level)],
+    )
+    dispatch_generations()
+
+
+def dispatch_generations() -> int:
+    """
+    Send queued tasks to the workers in fair-share order while slots are free. Returns the number of tasks sent.
+    """
+    redis_client = current_app.config["REDIS_CLIENT"]
+    dispatch = redis_client.register_script(DISPATCH_SCRIPT)
+    task_ids = dispatch(
+        keys=[READY_KEY, PASSES_KEY, WEIGHTS_KEY, VIRTUAL_TIME_KEY, IN_FLIGHT_KEY, RUNNING_KEY, RUNNING_USERS_KEY],
+        args=[time.time(), Config.SCHEDULER_MAX_IN_FLIGHT, Config.SCHEDULER_USER_MAX_IN_FLIGHT, Config.SCHEDULER_RUNNING_TTL],
+    )
+
+    for task_id in task_ids:
+        payload = redis_client.getdel(_payload_key(task_id))
+        if payload is None:
+            complete_generation(task_id, dispatch_next=False)
+            continue
+        payload = json.loads(payload)
+        celery_app.send_task(
+            "chat_generation_task",
+            args=(payload["chat_id"], payload["messages"], payload["use_cache"]),
+            task_id=task_id,
+        )
+    return len(task_ids)
+
+
+def complete_generation(task_id, dispatch_next=True):
+    """
+    Free the slot of a finished generation task and dispatch the next queued tasks.
+    """
+    redis_client = current_app.config["REDIS_CLIENT"]
+    complete = redis_client.register_script(COMPLETE_SCRIPT)
+    complete(keys=[IN_FLIGHT_KEY, RUNNING_KEY, RUNNING_USERS_KEY], args=[task_id])
+    if dispatch_next:
+        dispatch_generations()
+
@@ -0,0 +1,136 @@
+from flask import current_app
+from config import Config
+import json
+
+# Single-flight coalescing of identical generations.
+# The first task submitted for a prompt fingerprint becomes the leader and holds the flight lock.
+# Tasks submitted for the same fingerprint while the leader runs become its followers: they are not
+# sent to the workers, their clients stream the leader's chunks, and the leader's reply is saved to
+# each follower's chat when it finishes. If the leader is cancelled, its followers are handed over
+# to a new flight instead.
+
+
+def _lock_key(fingerprint) -> str:
+    return f"single_flight:{fingerprint}"
+
+
+def _followers_key(leader_id) -> str:
+    return f"single_flight:followers:{leader_id}"
+
+
+def _leader_key(task_id) -> str:
+    return f"single_flight:leader:{task_id}"
+
+
+def _fingerprint_key(leader_id) -> str:
+    return f"single_flight:fingerprint:{leader_id}"
+
+
+def _messages_key(leader_id) -> str:
+    return f"single_flight:messages:{leader_id}"
+
+
+# Become the leader of a fingerprint, or join the running leader as a follower. Returns the leader's task ID.
+JOIN_SCRIPT = """
+local lock, task_id, follower, ttl, fingerprint, messages = KEYS[1], ARGV[1], ARGV[2], tonumber(ARGV[3]), ARGV[4], ARGV[5]
+local leader = redis.call('GET', lock)
+if not leader then
+    redis.call('SET', lock, task_id, 'EX', ttl)
+    redis.call('SET', 'single_flight:fingerprint:' .. task_id, fingerprint, 'EX', ttl)
+    redis.call('SET', 'single_flight:messages:' .. task_id, messages, 'EX', ttl)
+    -- A follower handed over to a new flight may become its leader
+    redis.call('DEL', 'single_flight:leader:' .. task_id)
+    return task_id
+end
+local followers = 'single_flight:followers:' .. leader
+redis.call('HSET', followers, task_id, follower)
+redis.call('EXPIRE', followers, ttl)
+redis.call('SET', 'single_flight:leader:' .. task_id, leader, 'EX', ttl)
+return leader
+"""
+
+# End a flight: release the lock if the leader still holds it and take its followers.
+# Tasks submitted after this start a new flight, so no follower can be left behind.
+FINISH_SCRIPT = """
+local lock, followers, leader = KEYS[1], KEYS[2], ARGV[1]
+if redis.call('GET', lock) == leader then
+    redis.call('DEL', lock)
+end
+local members = redis.call('HVALS', followers)
+redis.call('DEL', followers)
+return members
+"""
+
+
+def join_flight(fingerprint, task_id, chat_id, messages, use_cache=False) -> str:
+    """
+    Register a task for a prompt fingerprint. Returns the task ID of the leader, which is task_id if the
+    task leads the flight and must be sent to the workers.
+    The messages are kept with the flight, so a follower can be sent to the workers if the leader is cancelled.
+    """
+    redis_client = current_app.config["REDIS_CLIENT"]
+    join = redis_client.register_script(JOIN_SCRIPT)
+    follower = json.dumps({"task_id": task_id, "chat_id": chat_id, "use_cache": use_cache})
+    args = [task_id, follower, Config.SINGLE_FLIGHT_TTL, fingerprint, json.dumps(messages, default=str)]
+    return join(keys=[_lock_key(fingerprint)], args=args)
+
+
+def get_flight_leader(task_id):
+    """
+    Get the task ID of the leader a follower task is attached to, or None if the task is not a follower.
+    """
+    redis_client = current_app.config["REDIS_CLIENT"]
+    return redis_client.get(_leader_key(task_id))
+
+
+def finish_flight(leader_id) -> list:
+    """
+    End the flight of a leader task and return its followers as dicts with task_id and chat_id.
+    Returns an empty list for tasks that do not lead a flight.
+    """
+    redis_client = current_app.config["REDIS_CLIENT"]
+    fingerprint = redis_client.getdel(_fingerprint_key(leader_id))
+    redis_client.delete(_messages_key(leader_id))
+    if fingerprint is None:
+        return []
+    finish = redis_client.register_script(FINISH_SCRIPT)
+    followers = finish(keys=[_lock_key(fingerprint), _followers_key(leader_id)], args=[leader_id])
+    return [json.loads(follower) for follower in followers]
+
+
+def hand_over_flight(leader_id) -> list:
+    """
+    End the flight of a cancelled leader task without sharing its reply. Its followers join a flight for the
+    same fingerprint again: the first one leads a new flight unless a newer one is already running, and the
+    others follow it. Returns the followers that now lead a flight and must be sent to the workers, as dicts
+    with task_id, chat_id, use_cache and messages.
+    """
+    redis_client = current_app.config["REDIS_CLIENT"]
+    fingerprint = redis_client.getdel(_fingerprint_key(leader_id))
+    messages = redis_client.getdel(_messages_key(leader_id))
+    if fingerprint is None:
+        return []
+    finish = redis_client.register_script(FINISH_SCRIPT)
+    followers = finish(keys=[_lock_key(fingerprint), _followers_key(leader_id)], args=[leader_id])
+
+    messages = json.loads(messages)
+    leaders = []
+    for follower in map(json.loads, followers):
+        if join_flight(fingerprint, follower["task_id"], follower["chat_id"], messages, follower["use_cache"]) == follower["task_id"]:
+            leaders.append({**follower, "messages": messages})
+    return leaders
+
+
+def leave_flight(task_id):
+    """
+    Detach a follower task from its leader. Returns the follower as a dict, or None if it was not attached.
+    """
+    redis_client = current_app.config["REDIS_CLIENT"]
+    leader_id = get_flight_leader(task_id)
+    if leader_id is None:
+        return None
+    followers_key = _followers_key(leader_id)
+    follower = redis_client.hget(followers_key, task_id)
+    if follower is None or not redis_client.hdel(followers_key, task_id):
+        return None
+    return json.loads(follower)
@@ -0,0 +1,422 @@
+from threading import Thread, Lock
+from contextlib import contextmanager
+from config import Config
+from uuid import uuid4
+import os
+import queue
+import time
+import json
+import pika
+import redis
+
+
+def format_sse(frame: dict, event_id=None) -> str:
+    """
+    Format a chunk frame as a Server-Sent Events message.
+    """
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {frame['status']}")
+    lines.append(f"data: {json.dumps(frame)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def broker_parameters() -> pika.ConnectionParameters:
+    return pika.ConnectionParameters(
+        Config.RABBITMQ_HOST,
+        Config.RABBITMQ_PORT,
+        heartbeat=Config.RABBITMQ_HEARTBEAT,
+    )
+
+
+def declare_stream_exchange(channel):
+    """
+    Declare the direct exchange that carries the chunks of all generation tasks, routed by task ID.
+    Every chunk hub binds a queue of its own for the tasks it relays, so each process gets every frame.
+    """
+    channel.exchange_declare(exchange=Config.STREAM_EXCHANGE, exchange_type="direct", durable=True)
+
+
+class BrokerChannelPool:
+    """
+    A pool of channels on one long-lived RabbitMQ connection per process.
+    The connection is opened on first use, checked on every acquire, re-opened after it is lost, and never shared across a fork.
+    """
+
+    def __init__(self, parameters: pika.ConnectionParameters, max_idle_channels: int):
+        self.parameters = parameters
+        self.max_idle_channels = max_idle_channels
+        self._connection = None
+        self._pid = None
+        self._idle_channels = []
+        self._lock = Lock()
+
+    def _get_connection(self):
+        if self._pid != os.getpid():
+            # Connections inherited from the parent process must not be used
+            self._connection = None
+            self._idle_channels = []
+        if self._connection is not None and self._connection.is_open:
+            try:
+                # BlockingConnection only answers heartbeats during I/O, so a connection that sat idle longer than
+                # the heartbeat may have been closed by the broker while is_open still reports it as open
+                self._connection.process_data_events(time_limit=0)
+            except pika.exceptions.AMQPError:
+                self._connection = None
+        if self._connection is None or self._connection.is_closed:
+            self._connection = pika.BlockingConnection(self.parameters)
+            self._pid = os.getpid()
+            self._idle_channels = []
+        return self._connection
+
+    def acquire(self):
+        with self._lock:
+            connection = self._get_connection()
+            while self._idle_channels:
+                channel = self._idle_channels.pop()
+                if channel.is_open:
+                    return channel
+            return connection.channel()
+
+    def release(self, channel, discard=False):
+        with self._lock:
+            if discard or not channel.is_open or len(self._idle_channels) >= self.max_idle_channels:
+                if channel.is_open:
+                    channel.close()
+                return
+            self._idle_channels.append(channel)
+
+    @contextmanager
+    def channel(self):
+        """
+        Borrow a channel for the duration of a block. Channels are discarded if the block raises an AMQP error.
+        """
+        channel = self.acquire()
+        try:
+            yield channel
+        except pika.exceptions.AMQPError:
+            self.release(channel, discard=True)
+            raise
+        except BaseException:
+            self.release(channel)
+            raise
+        else:
+            self.release(channel)
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None and self._connection.is_open and self._pid == os.getpid():
+                self._connection.close()
+            self._connection = None
+            self._idle_channels = []
+
+
+def stream_key(task_id) -> str:
+    return f"task_stream:{task_id}"
+
+
+class RabbitMQChunkPublisher:
+    """
+    Publishes the frames of a task to the RabbitMQ stream exchange.
+    """
+
+    def __init__(self, channel, task_id):
+        self.channel = channel
+        self.task_id = task_id
+        self.seq = 0
+        declare_stream_exchange(channel)
+
+    def publish(self, frame: dict):
+        self.seq += 1
+        frame["seq"] = self.seq
+        self.channel.basic_publish(exchange=Config.STREAM_EXCHANGE, routing_key=self.task_id, body=json.dumps(frame))
+
+
+class RedisStreamChunkPublisher:
+    """
+    Appends the frames of a task to its Redis Stream.
+    Entry IDs are 0-<seq>, so clients can resume from the last sequence number they received.
+    The stream is capped at STREAM_MAX_LENGTH entries and expires STREAM_TTL seconds after the last frame.
+    """
+
+    def __init__(self, redis_client, task_id):
+        self.redis_client = redis_client
+        self.key = stream_key(task_id)
+        self.seq = 0
+
+    def publish(self, frame: dict):
+        self.seq += 1
+        frame["seq"] = self.seq
+        pipeline = self.redis_client.pipeline()
+        pipeline.xadd(
+            self.key,
+            {"frame": json.dumps(frame)},
+            id=f"0-{self.seq}",
+            maxlen=Config.STREAM_MAX_LENGTH,
+            approximate=True,
+        )
+        pipeline.expire(self.key, Config.STREAM_TTL)
+        pipeline.execute()
+
+
+class ChunkCoalescer:
+    """
+    Buffers the incremental output of a generation and publishes it as fewer, larger in_progress frames.
+    The buffer is flushed when it holds `max_bytes` bytes or its oldest delta is `max_delay` seconds old,
+    whichever comes first. The first delta is published right away so the reply starts streaming immediately.
+    The full text is accumulated in a list and only joined once.
+    """
+
+    def __init__(self, publisher, max_delay: float, max_bytes: int):
+        self.publisher = publisher
+        self.max_delay = max_delay
+        self.max_bytes = max_bytes
+        self._parts = []
+        self._pending = []
+        self._pending_bytes = 0
+        self._pending_since = None
+
+    def add(self, delta: str):
+        if not delta:
+            return
+        self._parts.append(delta)
+        self._pending.append(delta)
+        self._pending_bytes += len(delta.encode())
+        now = time.monotonic()
+        if self._pending_since is None:
+            self._pending_since = now
+        if (
+            len(self._parts) == 1
+            or self._pending_bytes >= self.max_bytes
+            or now - self._pending_since >= self.max_delay
+        ):
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        self.publisher.publish({"status": "in_progress", "content": "".join(self._pending)})
+        self._pending = []
+        self._pending_bytes = 0
+        self._pending_since = None
+
+    @property
+    def content(self) -> str:
+        return "".join(self._parts)
+
+
+@contextmanager
+def open_chunk_publisher(broker_pool: BrokerChannelPool, redis_client, task_id):
+    """
+    Open a publisher for the frames of a task on the transport selected by STREAM_TRANSPORT.
+    """
+    if Config.STREAM_TRANSPORT == "redis":
+        yield RedisStreamChunkPublisher(redis_client, task_id)
+        return
+    with broker_pool.channel() as channel:
+        yield RabbitMQChunkPublisher(channel, task_id)
+
+
+class RabbitMQChunkHub:
+    """
+    Relays the chunks of generation tasks from RabbitMQ to any number of local subscribers.
+    A single background thread owns the only broker connection of the process and consumes a private,
+    exclusive queue that is bound to the stream exchange for each task with local subscribers. Hubs of
+    other processes bind their own queues, so they never compete for the frames of a task.
+    """
+
+    def __init__(self, parameters: pika.ConnectionParameters):
+        self.parameters = parameters
+        self._subscribers = {}
+        self._commands = queue.Queue()
+        self._lock = Lock()
+        self._thread = None
+
+    def subscribe(self, task_id, offset=0) -> queue.Queue:
+        """
+        Start receiving the frames of a task. Frames are put on the returned queue as they arrive.
+        Frames published before the subscription are not delivered and `offset` is ignored, use the Redis Streams
+        transport for replay.
+        """
+        subscription = queue.Queue()
+        with self._lock:
+            subscribers = self._subscribers.setdefault(task_id, set())
+            if not subscribers:
+                self._commands.put(("consume", task_id))
+            subscribers.add(subscription)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = Thread(target=self._run, name="rabbitmq-chunk-hub", daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, task_id, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(task_id)
+            if subscribers is None:
+                return
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[task_id]
+                self._commands.put(("cancel", task_id))
+
+    def _dispatch(self, channel, method, properties, body):
+        frame = json.loads(body)
+        with self._lock:
+            subscribers = list(self._subscribers.get(method.routing_key, ()))
+        for subscription in subscribers:
+            subscription.put(frame)
+
+    def _run(self):
+        while True:
+            try:
+                connection = pika.BlockingConnection(self.parameters)
+                channel = connection.channel()
+                declare_stream_exchange(channel)
+                # The queue belongs to this connection and is deleted by the broker when it closes
+                hub_queue = channel.queue_declare(queue="", exclusive=True, auto_delete=True).method.queue
+                channel.basic_consume(queue=hub_queue, on_message_callback=self._dispatch, auto_ack=True)
+                bound = set()
+
+                # Resume the subscriptions that were active before a reconnect
+                with self._lock:
+                    for task_id in self._subscribers:
+                        self._commands.put(("consume", task_id))
+
+                while True:
+                    while not self._commands.empty():
+                        command, task_id = self._commands.get()
+                        if command == "consume" and task_id not in bound:
+                            channel.queue_bind(queue=hub_queue, exchange=Config.STREAM_EXCHANGE, routing_key=task_id)
+                            bound.add(task_id)
+                        elif command == "cancel" and task_id in bound:
+                            channel.queue_unbind(queue=hub_queue, exchange=Config.STREAM_EXCHANGE, routing_key=task_id)
+                            bound.discard(task_id)
+                    connection.process_data_events(time_limit=0.1)
+            except pika.exceptions.AMQPError:
+                time.sleep(1)
+
+
+class RedisStreamChunkHub:
+    """
+    Relays the chunks of generation tasks from Redis Streams to any number of local subscribers.
+    A single background thread reads all watched streams with one blocking XREAD.
+    New subscribers first get the backlog after their offset, so reconnecting clients can resume
+    and late subscribers get the whole reply.
+    """
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self._subscribers = {}
+        self._positions = {}
+        self._lock = Lock()
+        self._thread = None
+        # Adding an entry to this stream wakes the reader thread up when a new stream is watched
+        self._wakeup_key = f"task_stream_hub:{uuid4()}"
+        # The reader continues after the last wakeup it has seen, so a wakeup added between two reads is not missed
+        self._wakeup_id = "0-0"
+
+    def subscribe(self, task_id, offset=0) -> queue.Queue:
+        """
+        Start receiving the frames of a task after sequence number `offset`.
+        """
+        subscription = queue.Queue()
+        key = stream_key(task_id)
+        with self._lock:
+            watched = key in self._positions
+            # Replay the backlog while holding the lock, so that it is queued before any live frame
+            maximum = f"0-{self._positions[key]}" if watched else "+"
+            position = offset
+            for entry_id, fields in self.redis_client.xrange(key, min=f"(0-{offset}", max=maximum):
+                position = int(entry_id.split("-")[1])
+                subscription.put(json.loads(fields["frame"]))
+
+            if not watched:
+                self._positions[key] = position
+                self.redis_client.xadd(self._wakeup_key, {"wakeup": 1}, maxlen=1)
+                self.redis_client.expire(self._wakeup_key, 60)
+            self._subscribers.setdefault(key, {})[subscription] = offset
+
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = Thread(target=self._run, name="redis-chunk-hub", daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, task_id, subscription):
+        key = stream_key(task_id)
+        with self._lock:
+            subscribers = self._subscribers.get(key)
+            if subscribers is None:
+                return
+            subscribers.pop(subscription, None)
+            if not subscribers:
+                del self._subscribers[key]
+                del self._positions[key]
+
+    def _run(self):
+        while True:
+            with self._lock:
+                streams = {key: f"0-{position}" for key, position in self._positions.items()}
+            streams[self._wakeup_key] = self._wakeup_id
+            try:
+                results = self.redis_client.xread(streams, block=Config.STREAM_HUB_BLOCK_MS)
+            except redis.exceptions.ConnectionError:
+                time.sleep(1)
+                continue
+
+            with self._lock:
+                for key, entries in results:
+                    if key == self._wakeup_key:
+                        self._wakeup_id = entries[-1][0]
+                        continue
+                    if key not in self._positions:
+                        continue
+                    for entry_id, fields in entries:
+                        seq = int(entry_id.split("-")[1])
+                        if seq <= self._positions[key]:
+                            continue
+                        self._positions[key] = seq
+                        frame = json.loads(fields["frame"])
+                        for subscription, offset in self._subscribers[key].items():
+                            # Subscribers that resumed ahead of the hub already have this frame
+                            if seq > offset:
+                                subscription.put(frame)
+
+
+_chunk_hub = None
+_chunk_hub_lock = Lock()
+
+
+def get_chunk_hub(redis_client):
+    """
+    Get the chunk hub of this process for the transport selected by STREAM_TRANSPORT, creating it on first use.
+    """
+    global _chunk_hub
+    with _chunk_hub_lock:
+        if _chunk_hub is None:
+            if Config.STREAM_TRANSPORT == "redis":
+                _chunk_hub = RedisStreamChunkHub(redis_client)
+            else:
+                _chunk_hub = RabbitMQChunkHub(broker_parameters())
+        return _chunk_hub
+
+
+def relay_task_stream(subscription, heartbeat_interval, timeout, hold=()):
+    """
+    Yield the frames of a subscription as SSE messages until the final frame arrives or the stream times out.
+    Comment lines are sent while waiting so that proxies keep the connection open.
+    A final frame whose status is in `hold` is returned instead of sent, so the caller can decide how the stream goes on.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            frame = subscription.get(timeout=heartbeat_interval)
+        except queue.Empty:
+            yield ": keep-alive\n\n"
+            continue
+        if frame["status"] in hold:
+            return frame
+        yield format_sse(frame, frame.get("seq"))
+        if frame["status"] != "in_progress":
+            return None
+    return None
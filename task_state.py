@@ -0,0 +1,94 @@
+from flask import current_app
+from config import Config
+import json
+import time
+
+
+def _owner_key(task_id) -> str:
+    return f"task_owner:{task_id}"
+
+
+def set_task_owner(task_id, user_id):
+    """
+    Remember which user started a task, so that task endpoints can check ownership without reading the chat.
+    """
+    redis_client = current_app.config["REDIS_CLIENT"]
+    redis_client.set(_owner_key(task_id), user_id, ex=Config.TASK_STATE_TTL)
+
+
+def get_task_owner(task_id):
+    """
+    Get the ID of the user who started a task, or None if the task is unknown or expired.
+    """
+    redis_client = current_app.config["REDIS_CLIENT"]
+    owner_id = redis_client.get(_owner_key(task_id))
+    return int(owner_id) if owner_id is not None else None
+
+
+def _status_key(task_id) -> str:
+    return f"task_status:{task_id}"
+
+
+def _status_channel(task_id) -> str:
+    return f"task_done:{task_id}"
+
+
+def set_task_status(task_id, status, result=None):
+    """
+    Record the final status of a task and wake up the clients waiting for it.
+    """
+    redis_client = current_app.config["REDIS_CLIENT"]
+    payload = json.dumps({"id": task_id, "status": status, "result": result})
+    pipeline = redis_client.pipeline()
+    pipeline.set(_status_key(task_id), payload, ex=Config.TASK_STATE_TTL)
+    pipeline.publish(_status_channel(task_id), payload)
+    pipeline.execute()
+
+
+def get_task_status(task_id):
+    """
+    Get the final status of a task as a dict, or None if the task has not finished yet.
+    """
+    redis_client = current_app.config["REDIS_CLIENT"]
+    payload = redis_client.get(_status_key(task_id))
+    return json.loads(payload) if payload else None
+
+
+def wait_for_task_status(task_id, timeout):
+    """
+    Block for up to `timeout` seconds until a task finishes and return its final status, or None on timeout.
+    """
+    redis_client = current_app.config["REDIS_CLIENT"]
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    try:
+        pubsub.subscribe(_status_channel(task_id))
+        # The task may have finished before the subscription was active
+        status = get_task_status(task_id)
+        if status is not None:
+            return status
+
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            message = pubsub.get_message(timeout=remaining)
+            if message is not None and message["type"] == "message":
+                return json.loads(message["data"])
+        return None
+    finally:
+        pubsub.close()
+
+
+def _cancel_key(task_id) -> str:
+    return f"task_cancel:{task_id}"
+
+
+def request_task_cancel(task_id):
+    """
+    Ask a running or queued generation task to stop. The worker checks the flag while streaming.
+    """
+    redis_client = current_app.config["REDIS_CLIENT"]
+    redis_client.set(_cancel_key(task_id), 1, ex=Config.TASK_STATE_TTL)
+
+
+def is_task_cancelled(task_id) -> bool:
+    redis_client = current_app.config["REDIS_CLIENT"]
+    return redis_client.exists(_cancel_key(task_id)) == 1
@@ -1,52 +1,100 @@
 from orm_models.chat import ChatORM
 from orm_models.preset import PresetORM
-from celery import Celery, Task, current_task
+from orm_models.user import UserORM
+from celery import Task, current_task
+from celery.signals import worker_process_shutdown
 from celery.result import AsyncResult
 from flask import current_app
 from http import HTTPStatus
 from dashscope import Generation
-from extensions import db
+from extensions import db, celery_app
 from datetime import datetime
-from orm_models.usage import UsageORM
+import time
+from credit_ledger import record_usage, settle_credits, reconcile_credit_ledger
 from config import Config
-import pika
-import json
+from task_state import set_task_status, get_task_owner, is_task_cancelled
+from generation_limiter import acquire_generation_slot
+from scheduler import submit_generation, complete_generation
+from single_flight import finish_flight, hand_over_flight
+from result_cache import get_fingerprint, get_cached_result, store_result, replay_result
+from chat_summary import needs_summary, claim_summary, release_summary, summarize_chat
+from streaming import open_chunk_publisher, ChunkCoalescer, broker_parameters, BrokerChannelPool
+
+GENERATION_MODEL = Generation.Models.qwen_max
+GENERATION_PARAMETERS = {"result_format": "message", "incremental_output": True}
+
+# One RabbitMQ connection per worker process, shared by all the tasks it runs
+broker_pool = BrokerChannelPool(broker_parameters(), Config.RABBITMQ_MAX_IDLE_CHANNELS)
+
+
+@worker_process_shutdown.connect
+def close_broker_pool(**kwargs):
+    broker_pool.close()
 
-celery_app = Celery("tasks", backend=Config.CELERY_RESULT_BACKEND, broker=Config.CELERY_BROKER_URL)
 
 class ChatGenerationTask(Task):
     name = "chat_generation_task"
 
-    def run(self, chat_id: int, messages: list):
+    def run(self, chat_id: int, messages: list, use_cache: bool = False):
         self.chat_id = chat_id
+        self.cancelled = False
+        self.source = "generation"
+        task_id = current_task.request.id
+
+        # Frames go to RabbitMQ on a pooled channel or to a Redis Stream, depending on STREAM_TRANSPORT
+        redis_client = current_app.config["REDIS_CLIENT"]
+        with open_chunk_publisher(broker_pool, redis_client, task_id) as publisher:
+            coalescer = ChunkCoalescer(publisher, Config.STREAM_COALESCE_DELAY, Config.STREAM_COALESCE_BYTES)
+            try:
+                # The task may have been cancelled while it was queued
+                if is_task_cancelled(task_id):
+                    self.cancelled = True
+                    publisher.publish({"status": "cancelled", "content": ""})
+                    return ""
 
-        # Connect to RabbitMQ
-        connection = pika.BlockingConnection(pika.ConnectionParameters(current_app.config["RABBITMQ_HOST"], current_app.config["RABBITMQ_PORT"]))
-        channel = connection.channel()
-        channel.queue_declare(queue=current_task.request.id)
-
-        # Generate chat
-        responses = Generation.call(
-            Generation.Models.qwen_max,
-            messages=messages,
-            result_format='message',
-            stream=True,
-            incremental_output=True
-        )
-
-        full_content = ''
-        for response in responses:
-            if response.status_code == HTTPStatus.OK:
-                new_content = response.output.choices[0]['message']['content']
-                message = json.dumps({"status": "in_progress", "content": new_content})
-                channel.basic_publish(exchange='', routing_key=current_task.request.id, body=message)
-                full_content += new_content
-            else:
-                message = json.dumps({"status": "error", "content": response.message})
-                channel.basic_publish(exchange='', routing_key=current_task.request.id, body=message)
-                raise Exception(f"Error occurred while generating chat: {response.message}")
-
-        message = json.dumps({"status": "success", "content": full_content})
+                # Identical requests made with a cache-enabled preset are answered from the result cache
+                fingerprint = get_fingerprint(GENERATION_MODEL, GENERATION_PARAMETERS, messages) if use_cache else None
+                cached = get_cached_result(fingerprint) if fingerprint else None
+                if cached is not None:
+                    self.source = "cache"
+                    replay_result(coalescer, cached)
+                else:
+                    # Wait for a free generation slot of this model and API key
+                    lease = acquire_generation_slot(redis_client, GENERATION_MODEL, Config.DASHSCOPE_API_KEY)
+                    try:
+                        # Generate chat
+                        responses = Generation.call(GENERATION_MODEL, messages=messages, stream=True, **GENERATION_PARAMETERS)
+
+                        next_cancel_check = time.monotonic() + Config.TASK_CANCEL_CHECK_INTERVAL
+                        for response in responses:
+                            if response.status_code != HTTPStatus.OK:
+                                raise Exception(f"Error occurred while generating chat: {response.message}")
+                            coalescer.add(response.output.choices[0]['message']['content'])
+
+                            if time.monotonic() >= next_cancel_check:
+                                if is_task_cancelled(task_id):
+                                    # Closing the generator closes the upstream HTTP stream
+                                    responses.close()
+                                    self.cancelled = True
+                                    break
+                                lease.renew_if_due()
+                                next_cancel_check = time.monotonic() + Config.TASK_CANCEL_CHECK_INTERVAL
+                        coalescer.flush()
+                    finally:
+                        lease.release()
+            except Exception as e:
+                # Let streaming clients know the generation failed
+                try:
+                    publisher.publish({"status": "error", "content": str(e)})
+                except Exception:
+                    pass
+                raise
+
+            full_content = coalescer.content
+            publisher.publish({"status": "cancelled" if self.cancelled else "success", "content": full_content})
+
+        if fingerprint and self.source == "generation" and not self.cancelled:
+            store_result(fingerprint, full_content)
 
         return full_content
     
@@ -55,29 +103,171 @@ class ChatGenerationTask(Task):
         This method will be called when the chat generation task is successful.
         It will record the usage and add the generated content to the chat.
         """
-        chat = ChatORM.query.filter_by(id=self.chat_id).first()
+        save_generation_result(self.chat_id, task_id, retval, self.cancelled, self.source)
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        save_generation_failure(self.chat_id, task_id, exc)
+
+
+def settle_task_credits(task_id, token_used, chat_owner_id=None):
+    """
+    Settle the credit reservation of a task against the tokens it used. The reservation is found through the
+    user who started the task, so it is settled even if the chat was deleted while the task ran.
+    The chat owner, who started every task of the chat, is used if the task owner has expired.
+    """
+    owner_id = get_task_owner(task_id) or chat_owner_id
+    if owner_id is not None:
+        settle_credits(owner_id, task_id, token_used)
+
+
+def resolve_follower(save, chat_id, task_id, *args):
+    """
+    Save the outcome of a single flight to one of its followers with `save`.
+    If that fails, the follower is failed so its chat and credits are released. A follower whose chat was
+    deleted has already released its task, and must not keep the other followers waiting.
+    """
+    try:
+        save(chat_id, task_id, *args)
+    except Exception as e:
+        db.session.rollback()
+        if save is save_generation_failure:
+            return
+        try:
+            save_generation_failure(chat_id, task_id, e)
+        except Exception:
+            db.session.rollback()
+
+
+def resubmit_follower(chat_id, task_id, messages, use_cache):
+    """
+    Queue a follower that leads the flight it was handed over to, as a task of the user who started it.
+    Its chat is still claimed and its credits are still reserved.
+    """
+    owner_id = get_task_owner(task_id)
+    owner = UserORM.query.filter_by(id=owner_id).first() if owner_id is not None else None
+    if owner is None:
+        raise Exception("Task owner not found")
+    submit_generation(owner, task_id, chat_id, messages, use_cache)
+
+
+def save_generation_result(chat_id, task_id, content, cancelled=False, source="generation"):
+    """
+    Add a generated reply to its chat, bill it and mark the task as finished.
+    Cancelled tasks pass the partial reply, which is saved and billed the same way.
+    Replies served from the result cache are billed the same way but recorded with the "cache" usage source,
+    and replies shared with the followers of a single flight with the "coalesced" source.
+    The partial reply of a cancelled task is not shared, its followers are handed over to a new flight.
+    """
+    token_used = 0
+    chat_owner_id = None
+    try:
+        chat = ChatORM.query.filter_by(id=chat_id).first()
         if not chat:
             raise Exception("Chat not found")
-        
-        # Record usage
-        usage = UsageORM(user_id=chat.owner_id, token_used=len(retval))
-        db.session.add(usage)
+        chat_owner_id = chat.owner_id
+
+        if content:
+            # Record usage
+            record_usage(chat.owner_id, len(content), source)
 
-        # Add message to chat
-        new_content = {"type": "chat", "role": "assistant", "content": retval, "visible": True, "created_at": datetime.now()}
-        chat.add_message(new_content)
+            # Add message to chat
+            new_content = {"type": "text", "role": "assistant", "content": content, "visible": True, "created_at": datetime.now()}
+            chat.add_message(new_content)
 
         # Remove task ID from chat
         chat.task_id = None
         db.session.commit()
+        token_used = len(content)
 
-    def on_failure(self, exc, task_id, args, kwargs, einfo):
-        chat = ChatORM.query.filter_by(id=self.chat_id).first()
+        # Fold older messages into the chat summary in the background
+        if needs_summary(chat) and claim_summary(chat.id):
+            chat_summary_task.delay(chat.id)
+
+        # Wake up the clients long-polling the task
+        set_task_status(task_id, "REVOKED" if cancelled else "SUCCESS", content)
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        # Replace the credit reservation with the usage committed above, or release it if nothing was billed
+        settle_task_credits(task_id, token_used, chat_owner_id)
+
+        # Free the scheduler slot for the next queued task, even if the chat was deleted
+        complete_generation(task_id)
+
+        if cancelled:
+            # The identical requests that joined this generation did not ask to cancel it, one of them is generated instead
+            for leader in hand_over_flight(task_id):
+                resolve_follower(resubmit_follower, leader["chat_id"], leader["task_id"], leader["messages"], leader["use_cache"])
+        else:
+            # Identical requests that joined this generation get the reply in their own chats, even if this chat was deleted
+            for follower in finish_flight(task_id):
+                resolve_follower(save_generation_result, follower["chat_id"], follower["task_id"], content, False, "coalesced")
+
+
+def save_generation_failure(chat_id, task_id, exc):
+    """
+    Release the chat and the credit reservation of a failed generation task.
+    """
+    chat_owner_id = None
+    try:
+        chat = ChatORM.query.filter_by(id=chat_id).first()
         if not chat:
             raise Exception("Chat not found")
+        chat_owner_id = chat.owner_id
 
         chat.task_id = None
         db.session.commit()
 
+        set_task_status(task_id, "FAILURE", str(exc))
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        settle_task_credits(task_id, 0, chat_owner_id)
+        complete_generation(task_id)
+
+        for follower in finish_flight(task_id):
+            resolve_follower(save_generation_failure, follower["chat_id"], follower["task_id"], exc)
+
+
+class ChatSummaryTask(Task):
+    name = "chat_summary_task"
+
+    def run(self, chat_id: int):
+        """
+        Update the rolling summary of a chat with the messages added since the last summary.
+        """
+        try:
+            chat = ChatORM.query.filter_by(id=chat_id).first()
+            if not chat:
+                return 0
+            return summarize_chat(chat)
+        finally:
+            release_summary(chat_id)
+
+
+class CreditReconciliationTask(Task):
+    name = "credit_reconciliation_task"
+
+    def run(self):
+        """
+        Rebuild the users' usage counters from the usages table and reset the cached balances.
+        """
+        return reconcile_credit_ledger()
+
+
+chat_generation_task = celery_app.register_task(ChatGenerationTask())
+chat_summary_task = celery_app.register_task(ChatSummaryTask())
+credit_reconciliation_task = celery_app.register_task(CreditReconciliationTask())
+
+# In asyncio mode, generation tasks are consumed by async_worker.py instead of the prefork workers
+if Config.GENERATION_WORKER_MODE == "asyncio":
+    celery_app.conf.task_routes = {ChatGenerationTask.name: {"queue": Config.ASYNC_GENERATION_QUEUE}}
 
-celery_app.tasks.register(ChatGenerationTask)
+celery_app.conf.beat_schedule = {
+    "reconcile-credit-ledger": {
+        "task": CreditReconciliationTask.name,
+        "schedule": Config.CREDIT_RECONCILE_INTERVAL,
+    },
+}
@@ -1,4 +1,6 @@
-from flask import current_app
+from flask import current_app, request
+from werkzeug.http import http_date
+from datetime import datetime, timezone
 from PIL import Image
 from io import BytesIO
 import hashlib
@@ -15,6 +17,41 @@ def generate_random_string(length) -> str:
     return "".join(random.choice(characters) for _ in range(length))
 
 
+def make_etag(*parts) -> str:
+    """
+    Build a strong ETag from the parts that identify a version of a resource, e.g. its ID and version counter or body.
+    """
+    return hashlib.sha1("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+def _to_utc(last_modified) -> datetime:
+    if isinstance(last_modified, str):
+        last_modified = datetime.fromisoformat(last_modified)
+    return last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+
+
+def conditional_headers(etag, last_modified=None) -> dict:
+    """
+    Get the ETag and Last-Modified headers for a response.
+    """
+    headers = {"ETag": f'"{etag}"'}
+    if last_modified:
+        headers["Last-Modified"] = http_date(_to_utc(last_modified))
+    return headers
+
+
+def is_not_modified(etag, last_modified=None) -> bool:
+    """
+    Check the request's If-None-Match and If-Modified-Since headers against the current version of a resource.
+    If-Modified-Since is only used when the request has no If-None-Match.
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if last_modified and request.if_modified_since:
+        return _to_utc(last_modified) <= request.if_modified_since
+    return False
+
+
 def save_avatar(avatar) -> str:
     """
     Save the avatar to the static folder in WEBP format and return the hash of the image.